@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Startup benchmark for the ogscm command line tool
+
+Measures the import time of ogscm.cli, the wall time of `ogscm --version` and
+of generating a definition with the compiler.py recipe (no network access
+required). Fails when a heavy module is imported on the --version path or when
+a measurement exceeds its limit.
+
+    python benchmarks/startup.py [--repeat 5] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules which must not be loaded by `import ogscm.cli` / `ogscm --version`
+HEAVY_MODULES = ["archspec", "hpccm", "requests", "yaml"]
+
+
+def wall_time(cmd, cwd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-import", type=float, default=0.15, help="seconds")
+    parser.add_argument("--max-version", type=float, default=0.3, help="seconds")
+    parser.add_argument("--max-generate", type=float, default=3.0, help="seconds")
+    parser.add_argument("--json", type=str, default="", help="Write results to file")
+    args = parser.parse_args()
+
+    python = sys.executable
+    failures = []
+
+    loaded = subprocess.check_output(
+        [
+            python,
+            "-c",
+            "import sys, ogscm.cli; "
+            "print(' '.join(sorted({m.split('.')[0] for m in sys.modules})))",
+        ],
+        text=True,
+    ).split()
+    heavy = [m for m in HEAVY_MODULES if m in loaded]
+    if heavy:
+        failures.append(f"import ogscm.cli loads {', '.join(heavy)}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {
+            "import": wall_time(
+                [python, "-c", "import ogscm.cli"], tmp_dir, args.repeat
+            ),
+            "version": wall_time(
+                [python, "-m", "ogscm.cli", "--version"], tmp_dir, args.repeat
+            ),
+            "generate": wall_time(
+                [python, "-m", "ogscm.cli", "compiler.py", "--out", tmp_dir],
+                tmp_dir,
+                args.repeat,
+            ),
+        }
+    baseline = wall_time([python, "-c", "pass"], os.getcwd(), args.repeat)[0]
+
+    limits = {
+        "import": args.max_import,
+        "version": args.max_version,
+        "generate": args.max_generate,
+    }
+    print(f"{'':10} {'min [s]':>10} {'median [s]':>10} {'limit [s]':>10}")
+    print(f"{'python':10} {baseline:10.3f}")
+    for name, (minimum, median) in results.items():
+        print(f"{name:10} {minimum:10.3f} {median:10.3f} {limits[name]:10.3f}")
+        # Interpreter startup is not under our control
+        if minimum - baseline > limits[name]:
+            failures.append(
+                f"{name} took {minimum - baseline:.3f}s (w/o interpreter "
+                f"startup), limit is {limits[name]}s"
+            )
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(
+                {
+                    "python": baseline,
+                    "results": {
+                        k: {"min": v[0], "median": v[1]} for k, v in results.items()
+                    },
+                    "failures": failures,
+                },
+                fp,
+                indent=2,
+            )
+
+    for failure in failures:
+        print(f"ERROR: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
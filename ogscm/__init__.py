@@ -1,3 +1,4 @@
 from __future__ import absolute_import
 
 from ogscm.common import package_manager
+from ogscm.generator import Definition, generate
@@ -1,7 +1,22 @@
+import functools
+import hashlib
+import json
 import subprocess
 import sys
+import tarfile
 import re
 import os
+import time
+
+from ogscm.app.converter import (
+    converter,
+    read_manifest,
+    squash_options,
+    write_checksum,
+)
+from ogscm.app.report import archive_history, build_report, docker_history
+
+HASH_LABEL = "org.opengeosys.ogscm.hash"
 
 
 class builder(object):
@@ -15,6 +30,9 @@ class builder(object):
         self.__definition_file_path = definition_file_path
         self.__tag = tag
         self.__cwd = cwd
+        self.__deps_tag = kwargs.get("deps_tag", "")
+        self.__deps_definition_file_path = kwargs.get("deps_definition_file_path", "")
+        self.__report = build_report()
 
     def build(self):
         if self.__format == "singularity":
@@ -31,26 +49,298 @@ class builder(object):
             check=True,
         )
         subprocess.run(f"sudo chown $USER {sif_file}", shell=True, check=True)
+        write_checksum(sif_file)
         print(f"Built Singularity image file: {sif_file}")
         # TODO: adapt this
         exit(0)
 
-    def build_docker(self):
-        build_cmd = (
-            f"DOCKER_BUILDKIT=1 docker build {self.__args.build_args} "
-            f"-t {self.__tag} -f {self.__definition_file_path} ."
+    def definition_hash(self):
+        """Hash of the definition and the build inputs, i.e. the build
+        arguments and, if the definition uses the build context, the state of
+        the build context (the current working directory)."""
+        with open(self.__definition_file_path, "rb") as f:
+            definition = f.read()
+        content_hash = hashlib.sha256(definition)
+        content_hash.update(self.__args.build_args.encode("utf-8"))
+        if re.search(
+            rb"--mount=type=bind|^(COPY|ADD) (?!--from)", definition, re.MULTILINE
+        ):
+            content_hash.update(self.__context_state())
+        return content_hash.hexdigest()
+
+    def __context_state(self):
+        # Git work tree: commit and local changes
+        git_state = subprocess.run(
+            "git rev-parse HEAD && git status --porcelain && git diff HEAD",
+            shell=True,
+            capture_output=True,
+        )
+        if git_state.returncode == 0:
+            return git_state.stdout
+        # Otherwise file names, sizes and modification times
+        state = []
+        for root, dirs, files in os.walk("."):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                state.append(f"{path} {stat.st_size} {stat.st_mtime_ns}")
+        return "\n".join(state).encode("utf-8")
+
+    def __image_base_name(self, image_id):
+        return f"{self.__images_out_dir}/{self.__img_file}-{image_id[0:12]}"
+
+    def __requested_image_files(self, image_id):
+        """Image files to create with the given options"""
+        image_base_name = self.__image_base_name(image_id)
+        image_files = []
+        if self.__args.convert:
+            if self.__args.sif_file:
+                image_files.append(f"{self.__images_out_dir}/{self.__args.sif_file}")
+            else:
+                image_files.append(f"{image_base_name}.sif")
+        if self.__args.convert_enroot:
+            if self.__args.enroot_file:
+                enroot_file = f"{self.__images_out_dir}/{self.__args.enroot_file}"
+            else:
+                enroot_file = f"{image_base_name}.sqsh"
+            image_files.append(enroot_file)
+            if self.__args.enroot_bundle:
+                image_files.append(f"{enroot_file[:-5]}.run")
+        return image_files
+
+    def __local_image_id(self, definition_hash):
+        """Id of the local image with tag if it was built from definition_hash"""
+        inspect = subprocess.run(
+            f"docker image inspect --format "
+            f"'{{{{.Id}}}} {{{{index .Config.Labels \"{HASH_LABEL}\"}}}}' "
+            f"{self.__tag}",
+            shell=True,
+            capture_output=True,
+            text=True,
         )
+        if inspect.returncode != 0:
+            return None
+        image_id, image_hash = (inspect.stdout.split() + ["", ""])[0:2]
+        if image_hash != definition_hash:
+            return None
+        return re.search(r"sha256:(\w*)", image_id).group(1)
+
+    def __docker_build(self, cache_suffix="", output=""):
+        """The docker build command. With a cache directory or reference the
+        layer cache (including all intermediate stages) is imported from and
+        exported to it which requires buildx. cache_suffix distinguishes the
+        caches of different images. With output (a buildx --output value) the
+        image is exported there instead of being loaded into the daemon."""
+        cache_args = []
+        if self.__args.cache_dir:
+            cache_dir = f"{os.path.abspath(self.__args.cache_dir)}{cache_suffix}"
+            if os.path.isfile(f"{cache_dir}/index.json"):
+                cache_args.append(f"--cache-from type=local,src={cache_dir}")
+            cache_args.append(f"--cache-to type=local,dest={cache_dir},mode=max")
+        if self.__args.cache_ref:
+            cache_ref = f"{self.__args.cache_ref}{cache_suffix}"
+            cache_args.append(f"--cache-from type=registry,ref={cache_ref}")
+            cache_args.append(f"--cache-to type=registry,ref={cache_ref},mode=max")
+        if output:
+            return " ".join(
+                ["docker buildx build --progress=plain", f"--output {output}"]
+                + cache_args
+            )
+        if not cache_args:
+            return "DOCKER_BUILDKIT=1 docker build --progress=plain"
+        return f"docker buildx build --load --progress=plain {' '.join(cache_args)}"
+
+    def __run_build(self, build_cmd, definition_file_path, tag, archive=""):
+        """Runs the build command, its output is shown and parsed for the
+        build report. Afterwards the layer sizes are taken from the image
+        history, or from the image archive the build wrote."""
         print(f"Running: {build_cmd}")
-        subprocess.run(build_cmd, shell=True, check=True)
-        inspect_out = subprocess.check_output(
-            f"docker inspect {self.__tag} | grep Id", shell=True
-        ).decode(sys.stdout.encoding)
-        image_id = re.search("sha256:(\w*)", inspect_out).group(1)
-        image_id_short = image_id[0:12]
+        self.__report.begin(definition_file_path, tag)
+        start = time.time()
+        with subprocess.Popen(
+            build_cmd,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        ) as process:
+            for line in process.stdout:
+                sys.stdout.write(line)
+                self.__report.parse(line)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, build_cmd)
+        self.__report.end(time.time() - start)
+        if archive:
+            self.__report.add_history(archive_history(archive))
+        else:
+            self.__add_image_history(tag)
+
+    def __add_image_history(self, tag):
+        """Adds the layer sizes of the image to the build report"""
+        history = subprocess.run(
+            f"docker history --no-trunc --human=false "
+            f"--format '{{{{.Size}}}}\t{{{{.CreatedBy}}}}' {tag}",
+            shell=True,
+            capture_output=True,
+            text=True,
+        )
+        if history.returncode == 0:
+            self.__report.add_history(docker_history(history.stdout))
+
+    def __check_size_budgets(self, built):
+        """Exits if the image or one of its building blocks exceeds its size
+        budget (--size-budget)"""
+        if not self.__args.size_budget:
+            return
+        if not built:
+            self.__report.begin(self.__definition_file_path, self.__tag)
+            self.__add_image_history(self.__tag)
+        if "size" not in self.__report.images[-1]:
+            print(f"WARNING: Size of {self.__tag} unknown, not checking budgets.")
+            return
+        exceeded = self.__report.check_budgets(self.__args.size_budget)
+        for message in exceeded:
+            print(f"ERROR: {message}!")
+        if exceeded:
+            exit(1)
+
+    def build_docker_deps(self):
+        """Builds the dependencies image unless it exists locally or in the
+        registry. Its tag is a hash of its definition."""
+        if (
+            subprocess.run(
+                f"docker image inspect {self.__deps_tag}",
+                shell=True,
+                capture_output=True,
+            ).returncode
+            == 0
+        ):
+            print(f"Reusing local dependencies image {self.__deps_tag}.")
+            if self.__args.upload and (self.__args.cache_dir or self.__args.cache_ref):
+                # The buildx builder of the image does not see the local one
+                subprocess.run(f"docker push {self.__deps_tag}", shell=True, check=True)
+            return
+        print(f"Pulling dependencies image {self.__deps_tag} ...")
+        if (
+            subprocess.run(
+                f"docker pull {self.__deps_tag}", shell=True, capture_output=True
+            ).returncode
+            == 0
+        ):
+            print(f"Reusing dependencies image {self.__deps_tag} from registry.")
+            return
+        build_cmd = (
+            f"{self.__docker_build('-deps')} {self.__args.build_args} "
+            f"-t {self.__deps_tag} -f {self.__deps_definition_file_path} ."
+        )
+        self.__run_build(build_cmd, self.__deps_definition_file_path, self.__deps_tag)
+        if self.__args.upload:
+            subprocess.run(f"docker push {self.__deps_tag}", shell=True, check=True)
+
+    def build_docker(self):
+        definition_hash = self.definition_hash()
+        state_file = f"{self.__images_out_dir}/{self.__img_file}.json"
+        image_id = None
+        # With --convert-direct the image is built into an OCI archive
+        oci_archive = ""
+        if self.__args.convert_direct:
+            oci_archive = f"{self.__images_out_dir}/{self.__img_file}.oci.tar"
+        state = {}
+        if os.path.isfile(state_file):
+            with open(state_file, "r") as f:
+                state = json.load(f)
+        # The squashfs image of other mksquashfs options is outdated
+        enroot_options = squash_options(
+            self.__args.squash_profile, self.__args.squash_options
+        )
+        squashfs_outdated = (
+            self.__args.convert_enroot and state.get("squash_options") != enroot_options
+        )
+        if not self.__args.force:
+            image_files = self.__requested_image_files(state.get("image_id", ""))
+            if (
+                state.get("hash") == definition_hash
+                and image_files
+                and all(os.path.exists(f) for f in image_files)
+                and not squashfs_outdated
+                and not self.__args.upload
+            ):
+                print(
+                    f"Image files {', '.join(image_files)} are up to date, "
+                    "skipping build and conversion."
+                )
+                self.image_file = [f for f in image_files if not f.endswith(".run")][-1]
+                return
+            if not oci_archive:
+                image_id = self.__local_image_id(definition_hash)
+            if image_id:
+                print(f"Image {self.__tag} is up to date, skipping build.")
+
+        if image_id is None:
+            if self.__deps_tag:
+                self.build_docker_deps()
+            output = f"type=oci,dest={oci_archive}" if oci_archive else ""
+            build_cmd = (
+                f"{self.__docker_build(output=output)} {self.__args.build_args} "
+                f"--label {HASH_LABEL}={definition_hash} "
+                f"-t {self.__tag} -f {self.__definition_file_path} ."
+            )
+            self.__run_build(
+                build_cmd, self.__definition_file_path, self.__tag, oci_archive
+            )
+            report_file = f"{self.__images_out_dir}/{self.__img_file}.report.json"
+            if self.__report.write(report_file):
+                print(f"Wrote build report {report_file}")
+            if "size" in self.__report.images[-1]:
+                print(self.__report.size_table())
+            if self.__args.slim_debug:
+                # With the same layer cache as the image, i.e. only the debug
+                # stage itself is built
+                debug_file = f"{self.__images_out_dir}/{self.__img_file}-debug.tar"
+                debug_build = self.__docker_build(output=f"type=tar,dest={debug_file}")
+                subprocess.run(
+                    f"{debug_build} {self.__args.build_args} --target debug "
+                    f"-f {self.__definition_file_path} .",
+                    shell=True,
+                    check=True,
+                )
+                print(f"Wrote debug symbols {debug_file}")
+            if oci_archive:
+                with tarfile.open(oci_archive, "r") as archive:
+                    image_id = read_manifest(archive)[0]
+            else:
+                inspect_out = subprocess.check_output(
+                    f"docker inspect {self.__tag} | grep Id", shell=True
+                ).decode(sys.stdout.encoding)
+                image_id = re.search("sha256:(\w*)", inspect_out).group(1)
+            self.__check_size_budgets(built=True)
+        else:
+            self.__check_size_budgets(built=False)
+        with open(f"{self.__definition_file_path}.hash", "w") as f:
+            f.write(f"{definition_hash}\n")
+        with open(state_file, "w") as f:
+            json.dump(
+                {
+                    "hash": definition_hash,
+                    "image_id": image_id,
+                    # Of the squashfs image
+                    "squash_options": (
+                        enroot_options
+                        if self.__args.convert_enroot
+                        else state.get("squash_options")
+                    ),
+                },
+                f,
+            )
 
         if self.__args.upload:
             subprocess.run(f"docker push {self.__tag}", shell=True, check=True)
-        image_base_name = f"{self.__images_out_dir}/{self.__img_file}-{image_id_short}"
+        image_base_name = self.__image_base_name(image_id)
+        # The conversions read one export of the image and run in parallel
+        archive = oci_archive or f"{image_base_name}.tar"
+        image_converter = converter(archive, self.__cwd, squash_options=enroot_options)
+        chains = []
         if self.__args.sif_file:
             self.image_file = f"{self.__images_out_dir}/{self.__args.sif_file}"
         else:
@@ -61,12 +351,7 @@ class builder(object):
                 or self.__args.force
                 or self.__args.sif_file
             ):
-                subprocess.run(
-                    f"cd {self.__cwd} && singularity build --force {self.image_file} docker-daemon:{self.__tag}",
-                    shell=True,
-                    check=True,
-                )
-                print(f"Built Singularity image file: {self.image_file}")
+                chains.append([functools.partial(image_converter.sif, self.image_file)])
             else:
                 print(f"Already existing Singularity image file: {self.image_file}")
 
@@ -74,24 +359,38 @@ class builder(object):
             self.image_file = f"{self.__images_out_dir}/{self.__args.enroot_file}"
         else:
             self.image_file = f"{image_base_name}.sqsh"
+        enroot_chain = []
         if self.__args.convert_enroot and (
-            not os.path.exists(self.image_file) or self.__args.force
+            not os.path.exists(self.image_file)
+            or self.__args.force
+            or squashfs_outdated
         ):
-            subprocess.run(
-                # See https://www.mankier.com/1/mksquashfs for options.
-                f"cd {self.__cwd} && rm -f {self.image_file} && ENROOT_SQUASH_OPTIONS='-comp xz -b 512K' enroot import -o {self.image_file} dockerd://{self.__tag}",
-                shell=True,
-                check=True,
+            enroot_chain.append(
+                functools.partial(image_converter.squashfs, self.image_file)
             )
-            print(f"Wrote image file {self.image_file}")
 
         bundle_file = f"{self.image_file[:-5]}.run"
         if self.__args.enroot_bundle and (
-            not os.path.exists(bundle_file) or self.__args.force
+            not os.path.exists(bundle_file) or self.__args.force or enroot_chain
         ):
+            enroot_chain.append(
+                functools.partial(image_converter.bundle, self.image_file, bundle_file)
+            )
+        if enroot_chain:
+            chains.append(enroot_chain)
+        if not chains:
+            if oci_archive:
+                os.remove(oci_archive)
+            return
+
+        # Bundling an existing squashfs image needs no export
+        if not oci_archive and any(x[0].func.__name__ != "bundle" for x in chains):
+            print(f"Exporting {self.__tag} to {archive} ...")
             subprocess.run(
-                f"cd {self.__cwd} && rm -f {bundle_file} && enroot bundle -o {bundle_file} {self.image_file}",
-                shell=True,
-                check=True,
+                f"docker save -o {archive} {self.__tag}", shell=True, check=True
             )
-            print(f"Wrote bundle file {bundle_file}")
+        try:
+            image_converter.run(chains)
+        finally:
+            if os.path.exists(archive):
+                os.remove(archive)
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# mksquashfs options of the --squash-profile values, see
+# https://www.mankier.com/1/mksquashfs for options.
+SQUASH_PROFILES = {
+    # Smallest, but slow to create and to decompress
+    "xz": "-comp xz -b 512K",
+    "zstd": "-comp zstd -Xcompression-level 15 -b 1M",
+    # Largest, fastest to decompress
+    "lz4": "-comp lz4 -Xhc -b 1M",
+    "gzip": "-comp gzip -b 1M",
+}
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+
+def _blob(digest):
+    return "blobs/{}/{}".format(*digest.split(":", 1))
+
+
+def _oci_manifest(archive, content):
+    """The image manifest of an OCI index or manifest, for a (multi-platform)
+    index the first one which is not an attestation"""
+    if "manifests" not in content:
+        return content
+    for descriptor in content["manifests"]:
+        if descriptor.get("platform", {}).get("os") != "unknown":
+            manifest = json.load(archive.extractfile(_blob(descriptor["digest"])))
+            return _oci_manifest(archive, manifest)
+    raise RuntimeError("No image manifest in the OCI archive!")
+
+
+def read_manifest(archive):
+    """Image id, config and layer member names of an opened image archive,
+    either written by `docker save` or an OCI archive (e.g. BuildKit
+    --output type=oci)"""
+    names = archive.getnames()
+    if "manifest.json" in names:
+        manifest = json.load(archive.extractfile("manifest.json"))[0]
+        config_name = manifest["Config"]
+        layers = manifest["Layers"]
+    else:
+        index = json.load(archive.extractfile("index.json"))
+        manifest = _oci_manifest(archive, index)
+        config_name = _blob(manifest["config"]["digest"])
+        layers = [_blob(x["digest"]) for x in manifest["layers"]]
+    config = archive.extractfile(config_name).read()
+    # The image id is the digest of the config
+    image_id = hashlib.sha256(config).hexdigest()
+    return image_id, json.loads(config), layers
+
+
+def _split(path):
+    return [x for x in path.split("/") if x not in ("", ".")]
+
+
+def _chroot_path(rootfs, path, follow_last=False):
+    """path relative to rootfs with the symlinks in it resolved as if rootfs
+    were /, i.e. absolute symlinks and .. never leave rootfs"""
+    parts = _split(path)
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        candidate = os.path.join(rootfs, *resolved, part)
+        if os.path.islink(candidate) and (parts or follow_last):
+            links += 1
+            if links > 40:
+                raise RuntimeError(f"Too many levels of symbolic links: {path}")
+            target = os.readlink(candidate)
+            if target.startswith("/"):
+                resolved = []
+            parts = _split(target) + parts
+            continue
+        resolved.append(part)
+    return "/".join(resolved)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _unpack_layer(layer, rootfs, modes):
+    """Applies a layer tar to rootfs, including the whiteouts. Opaque
+    whiteouts only hide the lower layers, so they are applied before the
+    entries of the layer. Devices are skipped and directories stay writable
+    for the following layers, their modes are collected in modes. The
+    ownership is set by mksquashfs -all-root."""
+    members = layer.getmembers()
+    for member in members:
+        parts = _split(member.name)
+        if parts and parts[-1] == OPAQUE_WHITEOUT:
+            parent = _chroot_path(rootfs, "/".join(parts[:-1]), follow_last=True)
+            directory = os.path.join(rootfs, parent)
+            for entry in os.listdir(directory) if os.path.isdir(directory) else []:
+                _remove(os.path.join(directory, entry))
+    for member in members:
+        parts = _split(member.name)
+        if not parts or parts[-1] == OPAQUE_WHITEOUT:
+            continue
+        name = parts[-1]
+        parent = _chroot_path(rootfs, "/".join(parts[:-1]), follow_last=True)
+        if name.startswith(WHITEOUT_PREFIX):
+            _remove(os.path.join(rootfs, parent, name[len(WHITEOUT_PREFIX) :]))
+            continue
+        if member.isdev():
+            continue
+        member.name = f"{parent}/{name}" if parent else name
+        target = os.path.join(rootfs, member.name)
+        if not (member.isdir() and os.path.isdir(target)):
+            _remove(target)
+        if member.islnk():
+            member.linkname = _chroot_path(rootfs, member.linkname)
+        os.makedirs(os.path.join(rootfs, parent), exist_ok=True)
+        if hasattr(tarfile, "fully_trusted_filter"):
+            # Paths are already confined to rootfs
+            layer.extract(member, rootfs, filter="fully_trusted")
+        else:
+            layer.extract(member, rootfs)
+        if member.isdir():
+            modes[member.name] = member.mode
+            os.chmod(target, member.mode | stat.S_IRWXU)
+
+
+def _rc(config):
+    """The enroot entrypoint script /etc/rc for the image config"""
+    entrypoint = " ".join(shlex.quote(x) for x in config.get("Entrypoint") or [])
+    cmd = " ".join(shlex.quote(x) for x in config.get("Cmd") or [])
+    if not entrypoint and not cmd:
+        cmd = "/bin/sh"
+    workdir = shlex.quote(config.get("WorkingDir") or "/")
+    return "\n".join(
+        [
+            f"mkdir -p {workdir} 2> /dev/null",
+            f"cd {workdir} && unset OLDPWD || exit 1",
+            "if [ -s /etc/rc.local ]; then",
+            "    . /etc/rc.local",
+            "fi",
+            "if [ $# -gt 0 ]; then",
+            f'    exec {entrypoint} "$@"',
+            "else",
+            f"    exec {entrypoint} {cmd}",
+            "fi",
+            "",
+        ]
+    )
+
+
+def remove_rootfs(rootfs):
+    """Removes an unpacked root file system including read-only
+    directories"""
+    for root, dirs, _ in os.walk(rootfs):
+        for name in dirs:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                os.chmod(path, stat.S_IRWXU)
+    shutil.rmtree(rootfs, ignore_errors=True)
+
+
+def write_checksum(image_file):
+    """Writes the manifest <image_file>.sha256 (sha256sum format) which the
+    deployer compares with the one on the hosts. Returns its content."""
+    checksum = hashlib.sha256()
+    with open(image_file, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    manifest = f"{checksum.hexdigest()}  {os.path.basename(image_file)}\n"
+    with open(f"{image_file}.sha256", "w") as f:
+        f.write(manifest)
+    return manifest
+
+
+def squash_options(profile, options=""):
+    """The mksquashfs options of a profile (SQUASH_PROFILES) or, for the
+    custom profile, the given options"""
+    if profile == "custom":
+        return options
+    return SQUASH_PROFILES[profile]
+
+
+class converter(object):
+    """Converts an image archive written by `docker save` or an OCI archive
+    to the Singularity and enroot image formats. The conversions run in
+    parallel, all of them read the same archive instead of exporting the
+    image from the Docker daemon again."""
+
+    def __init__(self, archive, cwd, **kwargs):
+        self.__archive = os.path.abspath(archive)
+        self.__cwd = cwd
+        self.__squash_options = kwargs.get("squash_options", SQUASH_PROFILES["xz"])
+
+    def sif(self, sif_file):
+        with tarfile.open(self.__archive, "r") as archive:
+            if "manifest.json" in archive.getnames():
+                transport = "docker-archive"
+            else:
+                transport = "oci-archive"
+        subprocess.run(
+            f"cd {self.__cwd} && singularity build --force {sif_file} "
+            f"{transport}:{self.__archive}",
+            shell=True,
+            check=True,
+        )
+        write_checksum(sif_file)
+        print(f"Built Singularity image file: {sif_file}")
+
+    def unpack(self, rootfs):
+        """Unpacks the image to the (empty) directory rootfs like `enroot
+        import`, including the enroot configuration of the environment,
+        volumes and entrypoint (/etc/environment, /etc/fstab, /etc/rc)"""
+        os.chmod(rootfs, 0o755)
+        modes = {}
+        with tarfile.open(self.__archive, "r") as archive:
+            _, config, layers = read_manifest(archive)
+            for layer_name in layers:
+                with tarfile.open(
+                    fileobj=archive.extractfile(layer_name), mode="r:*"
+                ) as layer:
+                    _unpack_layer(layer, rootfs, modes)
+        config = config.get("config", {})
+        etc = os.path.join(rootfs, _chroot_path(rootfs, "/etc", follow_last=True))
+        os.makedirs(etc, exist_ok=True)
+        with open(f"{etc}/environment", "w") as f:
+            f.writelines(f"{x}\n" for x in config.get("Env") or [])
+        # Volumes become tmpfs mounts
+        with open(f"{etc}/fstab", "w") as f:
+            f.writelines(
+                f"tmpfs {x} tmpfs x-create=dir,rw,nosuid,nodev\n"
+                for x in sorted(config.get("Volumes") or {})
+            )
+        with open(f"{etc}/rc", "w") as f:
+            f.write(_rc(config))
+        # Deepest first, a read-only directory still allows changing the
+        # modes in it
+        for path in sorted(modes, reverse=True):
+            if os.path.isdir(os.path.join(rootfs, path)):
+                os.chmod(os.path.join(rootfs, path), modes[path])
+
+    def squashfs(self, sqsh_file):
+        rootfs = tempfile.mkdtemp(
+            prefix=".rootfs-", dir=os.path.dirname(os.path.abspath(sqsh_file))
+        )
+        try:
+            self.unpack(rootfs)
+            subprocess.run(
+                f"cd {self.__cwd} && rm -f {sqsh_file} && "
+                f"mksquashfs {rootfs} {sqsh_file} -all-root -no-progress "
+                f"{self.__squash_options}",
+                shell=True,
+                check=True,
+            )
+        finally:
+            remove_rootfs(rootfs)
+        write_checksum(sqsh_file)
+        print(f"Wrote image file {sqsh_file}")
+
+    def bundle(self, sqsh_file, bundle_file):
+        subprocess.run(
+            f"cd {self.__cwd} && rm -f {bundle_file} && "
+            f"enroot bundle -o {bundle_file} {sqsh_file}",
+            shell=True,
+            check=True,
+        )
+        write_checksum(bundle_file)
+        print(f"Wrote bundle file {bundle_file}")
+
+    def run(self, chains):
+        """Runs the chains (lists of functions without arguments) in
+        parallel, the functions of a chain one after another. Raises the
+        first error."""
+
+        def run_chain(chain):
+            for function in chain:
+                function()
+
+        with ThreadPoolExecutor(max_workers=max(len(chains), 1)) as executor:
+            futures = [executor.submit(run_chain, x) for x in chains]
+            for future in futures:
+                future.result()
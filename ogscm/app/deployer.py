@@ -1,10 +1,48 @@
 import os
+import re
+import shlex
 import subprocess
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import yaml
 
+from ogscm.app.converter import write_checksum
+
+MB = 1000 * 1000
+
+
+def _stats_value(output, key):
+    """A byte count from the rsync --stats output, e.g. 'Total bytes sent'"""
+    match = re.search(rf"^{key}: ([\d,.]+)", output, re.MULTILINE)
+    if not match:
+        return 0
+    return int(re.sub(r"[,.]", "", match.group(1)))
+
 
 class deployer(object):
+    """Deploys the image file with rsync to the hosts in
+    config/deploy_hosts.yml, to jobs hosts at once. Hosts whose manifest
+    (<image file>.sha256, see write_checksum()) equals the local one are
+    skipped. Per host there may be given besides host and dest_dir:
+
+    user: The SSH user.
+    proxy: An SSH jump host.
+    bwlimit: The bandwidth limit of rsync, e.g. 50M (per second).
+    timeout: Seconds after which a transfer is aborted.
+    retries: Number of retries of a failed or aborted transfer, default 0.
+    relay: The host relays the image to the other hosts of its group, i.e.
+        it can reach them with SSH (with the forwarded agent).
+    group: Hosts which can reach each other, default: all hosts without a
+        group.
+
+    Only one host per group with relays receives the image from the build
+    host, from there it is relayed (fanout): in a binomial tree (tree) each
+    host which received it sends it on to the next one in parallel, in a
+    chain (chain) one host after another.
+    """
+
     def __init__(self, args_deploy, cwd, image_file, **kwargs):
         deploy_config_filename = f"{cwd}/config/deploy_hosts.yml"
         if not os.path.isfile(deploy_config_filename):
@@ -23,19 +61,255 @@ class deployer(object):
             deploy_hosts = deploy_config
         else:
             deploy_hosts[args_deploy] = deploy_config[args_deploy]
-        for deploy_host in deploy_hosts:
-            deploy_info = deploy_hosts[deploy_host]
-            print(f"Deploying to {deploy_info} ...")
-            proxy_cmd = ""
-            user_cmd = ""
-            if "user" in deploy_info:
-                user_cmd = f"{deploy_info['user']}@"
-            if "proxy" in deploy_info:
-                proxy_cmd = f"-e 'ssh -A -J {user_cmd}{deploy_info['proxy']}'"
-                print(proxy_cmd)
+        self.__image_file = image_file
+        self.__image_name = os.path.basename(image_file)
+        manifest_file = f"{image_file}.sha256"
+        if os.path.isfile(manifest_file) and os.path.getmtime(
+            manifest_file
+        ) >= os.path.getmtime(image_file):
+            with open(manifest_file, "r") as f:
+                self.__manifest = f.read()
+        else:
+            self.__manifest = write_checksum(image_file)
+        self.__jobs = kwargs.get("jobs", 4)
+        self.__fanout = kwargs.get("fanout", "tree")
+        self.__hosts = deploy_hosts
+        self.results = []
+
+        self.__distribute()
+        print(self.summary())
+        if any(x["error"] for x in self.results):
+            exit(1)
+
+    def __distribute(self):
+        """Deploys to all hosts, from the build host to jobs hosts at once and
+        from each relay to one host at once"""
+        groups = {}
+        for name, info in self.__hosts.items():
+            groups.setdefault(info.get("group", ""), []).append(name)
+        direct = []  # from the build host
+        pending = {}  # per group, from its relays
+        for group, names in groups.items():
+            relays = [x for x in names if self.__hosts[x].get("relay", False)]
+            if not relays:
+                direct += names
+                continue
+            # The first relay receives from the build host, the relays first
+            direct.append(relays[0])
+            pending[group] = relays[1:] + [x for x in names if x not in relays]
+        holders = {x: [] for x in pending}  # relays with the image
+        running = {}  # future: (source, target)
+        workers = max(self.__jobs, 1) + len(self.__hosts)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                busy = [x[0] for x in running.values()]
+                while direct and busy.count(None) < max(self.__jobs, 1):
+                    target = direct.pop(0)
+                    busy.append(None)
+                    running[executor.submit(self.__deploy, target)] = (None, target)
+                for group, targets in pending.items():
+                    in_flight = sum(
+                        1 for x in running.values() if self.__group(x[1]) == group
+                    )
+                    while targets:
+                        if self.__fanout == "chain" and in_flight:
+                            break
+                        # Most recent first: a chain continues from the last host
+                        idle = [x for x in reversed(holders[group]) if x not in busy]
+                        if not idle:
+                            break
+                        target = targets.pop(0)
+                        busy.append(idle[0])
+                        in_flight += 1
+                        future = executor.submit(self.__deploy, target, idle[0])
+                        running[future] = (idle[0], target)
+                    seeding = [x[1] for x in running.values()] + direct
+                    if not holders[group] and not any(
+                        self.__group(x) == group for x in seeding
+                    ):
+                        # The first relay failed, the next one from the build
+                        # host or, without relays left, all of them
+                        relays = [x for x in targets if self.__hosts[x].get("relay")]
+                        if relays:
+                            targets.remove(relays[0])
+                            direct.append(relays[0])
+                        else:
+                            direct += targets
+                            targets.clear()
+                if not running:
+                    if direct:
+                        continue
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source, target = running.pop(future)
+                    result = future.result()
+                    self.results.append(result)
+                    group = self.__group(target)
+                    if not result["error"]:
+                        if group in holders and self.__hosts[target].get("relay"):
+                            holders[group].append(target)
+                    elif source is not None:
+                        # Retry from the build host
+                        self.results.remove(result)
+                        direct.append(target)
+        order = list(self.__hosts)
+        self.results.sort(key=lambda x: order.index(x["host"]))
+
+    def __group(self, name):
+        return self.__hosts[name].get("group", "")
+
+    def __login(self, deploy_info):
+        if "user" in deploy_info:
+            return f"{deploy_info['user']}@{deploy_info['host']}"
+        return deploy_info["host"]
+
+    def __ssh(self, deploy_info, command, source=None):
+        """Runs command on the host deploy_info, from the build host or, if
+        given, from the relay source"""
+        if source is not None:
+            return self.__ssh(
+                self.__hosts[source],
+                f"ssh {self.__login(deploy_info)} {shlex.quote(command)}",
+            )
+        proxy_cmd = ""
+        if "proxy" in deploy_info:
+            proxy_cmd = (
+                f"-J {self.__login({**deploy_info, 'host': deploy_info['proxy']})}"
+            )
+        # exec: a timeout kills ssh, not only the shell
+        return (
+            f"exec ssh -A {proxy_cmd} {self.__login(deploy_info)} "
+            f"{shlex.quote(command)}"
+        )
+
+    def __rsync(self, deploy_info, dest_file, source=None):
+        """The rsync command to dest_file on deploy_info from the build host
+        or, if given, from the relay source"""
+        bwlimit_cmd = ""
+        if "bwlimit" in deploy_info:
+            bwlimit_cmd = f"--bwlimit={deploy_info['bwlimit']}"
+        destination = f"{self.__login(deploy_info)}:{dest_file}"
+        if source is not None:
+            image_file = f"{self.__hosts[source]['dest_dir']}/{self.__image_name}"
+            return self.__ssh(
+                self.__hosts[source],
+                f"rsync --stats {bwlimit_cmd} {image_file} {destination}",
+            )
+        proxy_cmd = ""
+        if "proxy" in deploy_info:
+            jump = self.__login({**deploy_info, "host": deploy_info["proxy"]})
+            proxy_cmd = f"-e 'ssh -A -J {jump}'"
+        return (
+            f"exec rsync --stats {bwlimit_cmd} {proxy_cmd} {self.__image_file} "
+            f"{destination}"
+        )
+
+    def __run(self, command, timeout):
+        """Runs command, returns the process or the error message"""
+        try:
+            process = subprocess.run(
+                command, shell=True, capture_output=True, text=True, timeout=timeout
+            )
+        except subprocess.TimeoutExpired:
+            return None, f"Timed out after {timeout} s"
+        if process.returncode != 0:
+            return None, (process.stderr.strip().splitlines() or ["?"])[-1]
+        return process, ""
+
+    def __deploy(self, deploy_host, source=None):
+        """Deploys to one host unless its manifest equals the local one.
+        rsync transfers the image as delta against the existing one to a
+        temporary file which it renames. The manifest is removed before
+        and written afterwards. Retries on failures."""
+        deploy_info = self.__hosts[deploy_host]
+        image_file = f"{deploy_info['dest_dir']}/{self.__image_name}"
+        temp_file = f"{deploy_info['dest_dir']}/.{self.__image_name}.sha256.tmp"
+        timeout = deploy_info.get("timeout")
+        result = {"host": deploy_host, "source": source, "attempts": 0, "error": ""}
+        start = time.time()
+        remote, _ = self.__run(
+            self.__ssh(
+                deploy_info, f"cat {image_file}.sha256 2>/dev/null || true", source
+            ),
+            timeout,
+        )
+        if remote and remote.stdout == self.__manifest:
+            print(f"{deploy_host} is up to date.")
+            result.update(
+                {
+                    "up_to_date": True,
+                    "time": time.time() - start,
+                    "transferred": 0,
+                    "sent": 0,
+                }
+            )
+            return result
+
+        print(f"Deploying to {deploy_info} from {source or 'build host'} ...")
+        # The manifest of an interrupted transfer would not match the image
+        prepare_cmd = self.__ssh(deploy_info, f"rm -f {image_file}.sha256", source)
+        finish_cmd = self.__ssh(
+            deploy_info,
+            f"printf %s {shlex.quote(self.__manifest)} > {temp_file} && "
+            f"mv -f {temp_file} {image_file}.sha256",
+            source,
+        )
+        for attempt in range(int(deploy_info.get("retries", 0)) + 1):
+            result["attempts"] = attempt + 1
+            start = time.time()
+            rsync = None
+            _, result["error"] = self.__run(prepare_cmd, timeout)
+            if not result["error"]:
+                rsync, result["error"] = self.__run(
+                    self.__rsync(deploy_info, image_file, source), timeout
+                )
+            if rsync:
+                _, result["error"] = self.__run(finish_cmd, timeout)
+            if not result["error"]:
+                result.update(
+                    {
+                        "time": time.time() - start,
+                        "transferred": _stats_value(
+                            rsync.stdout, "Total transferred file size"
+                        ),
+                        "sent": _stats_value(rsync.stdout, "Total bytes sent"),
+                    }
+                )
+                print(f"Deployed to {deploy_host}.")
+                return result
             print(
-                subprocess.check_output(
-                    f"rsync -c -v {proxy_cmd} {image_file} {user_cmd}{deploy_info['host']}:{deploy_info['dest_dir']}",
-                    shell=True,
-                ).decode(sys.stdout.encoding)
+                f"WARNING: Deploying to {deploy_host} failed (attempt "
+                f"{attempt + 1}): {result['error']}",
+                file=sys.stderr,
+            )
+        return result
+
+    def summary(self):
+        """Transferred bytes and throughput per host as Markdown table"""
+        lines = [
+            "| Host | From | Result | Attempts | Transferred [MB] | Sent [MB] "
+            "| Time [s] | Throughput [MB/s] |",
+            "| --- | --- | --- | ---: | ---: | ---: | ---: | ---: |",
+        ]
+        for result in self.results:
+            source = result["source"] or "build host"
+            if result.get("up_to_date"):
+                lines.append(
+                    f"| {result['host']} | | up to date | 0 | 0.0 | 0.0 "
+                    f"| {result['time']:.1f} | |"
+                )
+                continue
+            if result["error"]:
+                lines.append(
+                    f"| {result['host']} | {source} | {result['error']} "
+                    f"| {result['attempts']} | | | | |"
+                )
+                continue
+            throughput = result["sent"] / max(result["time"], 1e-9)
+            lines.append(
+                f"| {result['host']} | {source} | ok | {result['attempts']} "
+                f"| {result['transferred'] / MB:.1f} | {result['sent'] / MB:.1f} "
+                f"| {result['time']:.1f} | {throughput / MB:.1f} |"
             )
+        return "\n".join(lines)
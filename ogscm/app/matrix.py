@@ -0,0 +1,115 @@
+"""Generation of all definitions of a matrix of recipe options
+
+A matrix file (YAML) looks like:
+
+    recipes: [compiler.py, mpi.py, ogs.py]
+    options:  # for all definitions
+      ccache: true
+    matrix:  # all combinations of these values
+      compiler: [gcc, clang]
+      ompi: [4.0.5, 4.1.1]
+      ogs: [ogs/ogs@master, ogs/ogs@6.4.1]
+      cmake_args: ["", " -DOGS_BUILD_PROCESSES=LiquidFlow"]
+    exclude:  # combinations containing all of the given values
+      - compiler: clang
+        ompi: 4.0.5
+"""
+
+import contextlib
+import io
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+import ogscm
+from ogscm import config, resolver
+
+
+def _generate(recipes, options):
+    """Worker: generates one definition, it is written by the main process"""
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            definition = ogscm.generate(recipes, options)
+    except Exception as err:
+        return None, f"{output.getvalue()}{err.__class__.__name__}: {err}"
+    return definition, None
+
+
+def _normalized(options):
+    return {name.replace("-", "_"): value for name, value in options.items()}
+
+
+class matrix(object):
+    def __init__(self, matrix_file, **kwargs):
+        with open(matrix_file, "r") as ymlfile:
+            matrix_config = yaml.load(ymlfile, Loader=yaml.FullLoader)
+        self.__recipes = matrix_config["recipes"]
+        self.__options = _normalized(matrix_config.get("options") or {})
+        self.__matrix = _normalized(matrix_config.get("matrix") or {})
+        self.__exclude = [_normalized(e) for e in matrix_config.get("exclude") or []]
+        self.__options.update(_normalized(kwargs.get("options", {})))
+
+    def combinations(self):
+        """Returns the options of all definitions"""
+        names = list(self.__matrix.keys())
+        combinations = []
+        for values in itertools.product(*[self.__matrix[n] for n in names]):
+            combination = dict(zip(names, values))
+            if any(
+                all(combination.get(k) == v for k, v in exclude.items())
+                for exclude in self.__exclude
+            ):
+                continue
+            options = dict(self.__options)
+            options.update(combination)
+            combinations.append(options)
+        return combinations
+
+    def generate(self, jobs=None):
+        """Generates all definitions in parallel, returns the number of
+        failed definitions. Nothing is written if definitions fail or would
+        overwrite each other."""
+        combinations = self.combinations()
+        config.set_offline(self.__options.get("offline", False))
+        if "cache_ttl" in self.__options:
+            config.set_cache_ttl(self.__options["cache_ttl"])
+        if "ogs.py" in self.__recipes:
+            # Resolve once here, workers use the (inherited or on-disk) cache
+            resolver.prefetch(set(o.get("ogs", "ogs/ogs@master") for o in combinations))
+
+        print(f"Generating {len(combinations)} definitions ...")
+        failed = 0
+        definitions = {}  # by definition file
+        with ProcessPoolExecutor(
+            max_workers=jobs or multiprocessing.cpu_count()
+        ) as executor:
+            futures = [
+                executor.submit(_generate, self.__recipes, options)
+                for options in combinations
+            ]
+            for options, future in zip(combinations, futures):
+                definition, error = future.result()
+                if error:
+                    failed += 1
+                    print(f"ERROR: Failed to generate {options}:\n{error}")
+                    continue
+                definition_file = os.path.abspath(definition.definition_file_path)
+                if definition_file in definitions:
+                    failed += 1
+                    print(
+                        f"ERROR: {options} and {definitions[definition_file][0]} "
+                        f"have the same definition file {definition_file}!"
+                    )
+                    continue
+                definitions[definition_file] = (options, definition)
+        if failed:
+            print("No definitions written.")
+            return failed
+        for definition_file, (_, definition) in definitions.items():
+            definition.write()
+            print(f"Created definition {definition_file}")
+        return failed
@@ -0,0 +1,441 @@
+import gzip
+import json
+import re
+import tarfile
+
+from ogscm.app.converter import read_manifest
+from ogscm.building_blocks.ccache import STATS_MARKER
+
+# Statistics as printed by ccache --show-stats of ccache 3.x
+SHOW_STATS_KEYS = {
+    "cache hit (direct)": "direct_cache_hit",
+    "cache hit (preprocessed)": "preprocessed_cache_hit",
+    "cache miss": "cache_miss",
+    "called for link": "called_for_link",
+    "files in cache": "files_in_cache",
+    "cache size": "cache_size",
+}
+
+# Layers of the base images are not in the definition
+UNATTRIBUTED = "(base image)"
+
+# BuildKit --progress=plain output
+_vertex_re = re.compile(r"^#(\d+) \[(?:(\S+) )?\s*\d+/\d+\] (.*)$")
+_done_re = re.compile(r"^#(\d+) DONE ([\d.]+)s")
+_cached_re = re.compile(r"^#(\d+) CACHED")
+_error_re = re.compile(r"^#(\d+) ERROR")
+
+
+_SIZE_UNITS = {"": 1, "k": 1e3, "m": 1e6, "g": 1e9, "t": 1e12}
+
+
+def parse_size(size):
+    """Size in bytes of e.g. 500MB, 3.5G or 2GiB"""
+    match = re.match(r"^\s*([\d.]+)\s*([kmgt]?)(i?)b?\s*$", size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size {size}!")
+    number, unit, binary = match.groups()
+    factor = _SIZE_UNITS[unit.lower()]
+    if binary and unit:
+        factor = 1024 ** list(_SIZE_UNITS).index(unit.lower())
+    return int(float(number) * factor)
+
+
+def docker_history(history):
+    """Layers (size in bytes, created by) of the output of `docker history
+    --no-trunc --human=false --format '{{.Size}}\t{{.CreatedBy}}'`, newest
+    first"""
+    layers = []
+    for line in history.strip().split("\n"):
+        size, _, created_by = line.partition("\t")
+        if size.isdigit():
+            layers.append((int(size), created_by))
+    return layers
+
+
+def _layer_size(archive, name):
+    """Uncompressed size of a layer, the layers of OCI archives are
+    compressed"""
+    layer = archive.extractfile(name)
+    if layer.read(2) != b"\x1f\x8b":
+        return archive.getmember(name).size
+    layer.seek(0)
+    size = 0
+    with gzip.GzipFile(fileobj=layer) as uncompressed:
+        while True:
+            chunk = uncompressed.read(1 << 20)
+            if not chunk:
+                return size
+            size += len(chunk)
+
+
+def archive_history(path):
+    """Layers (size in bytes, created by) of an image archive written by
+    `docker save` or an OCI archive, newest first"""
+    with tarfile.open(path, "r") as archive:
+        _, config, layer_names = read_manifest(archive)
+        layer_sizes = [_layer_size(archive, x) for x in layer_names]
+    layers = []
+    for entry in config.get("history", []):
+        size = 0
+        if not entry.get("empty_layer", False) and layer_sizes:
+            size = layer_sizes.pop(0)
+        layers.append((size, entry.get("created_by", "")))
+    return list(reversed(layers))
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text.replace("\\\n", " ")).strip()
+
+
+def _instruction_key(instruction):
+    """Instruction without options like --mount or --from, as used for
+    matching the image history"""
+    keyword, _, arguments = instruction.partition(" ")
+    arguments = re.sub(r"^(--\S+ )+", "", arguments)
+    return f"{keyword.upper()} {arguments}".strip()
+
+
+def _label(instruction):
+    """Block name of an instruction without comment, e.g. of the packages
+    building block"""
+    packages = re.search(
+        r"\b(?:apt-get|yum) install (?:-\S+ )*(.+?)(?: &&|$)", instruction
+    )
+    if packages:
+        return f"packages: {packages.group(1)}"[:60]
+    return instruction[:60]
+
+
+def definition_steps(definition):
+    """The instructions of a Dockerfile with the recipe (from the `--- Begin
+    <recipe> ---` comments) and the building block (from the preceding
+    comment) that emitted them."""
+    steps = []
+    recipe = ""
+    block = ""
+    stage = ""
+    stage_count = 0
+    stages = []
+    comment_run = False
+    for line in re.sub(r"\\\n", " ", definition).split("\n"):
+        line = line.strip()
+        if not line:
+            # Layers of a stage are separated by empty lines
+            block = ""
+            comment_run = False
+            continue
+        if line.startswith("#"):
+            text = line.lstrip("#").strip()
+            begin = re.match(r"--- (Begin|End) (\S+) ---", text)
+            if begin:
+                recipe = begin.group(2) if begin.group(1) == "Begin" else ""
+            elif not comment_run and not text.startswith("syntax="):
+                block = text
+            comment_run = True
+            continue
+        comment_run = False
+        instruction = _normalize(line)
+        if instruction.upper().startswith("FROM "):
+            if instruction.split()[1] not in stages:
+                # E.g. the runtime stage, not started by a recipe
+                recipe = ""
+            stage_as = re.search(r"\bAS (\S+)$", instruction, re.IGNORECASE)
+            stage = stage_as.group(1) if stage_as else f"stage-{stage_count}"
+            stage_count += 1
+            stages.append(stage)
+            instruction = "FROM"
+        steps.append(
+            {
+                "recipe": recipe,
+                "block": block or _label(instruction),
+                "stage": stage,
+                "instruction": instruction,
+            }
+        )
+    return steps
+
+
+class build_report(object):
+    """Machine-readable report of a build, collected from the build output."""
+
+    def __init__(self):
+        self.ccache = {}
+        self.images = []
+        self.__steps = []
+        self.__vertices = {}
+
+    def begin(self, definition_file_path, tag):
+        """Starts the report of the build of the given definition"""
+        with open(definition_file_path, "r") as f:
+            self.__steps = definition_steps(f.read())
+        self.__vertices = {}
+        self.images.append(
+            {
+                "tag": tag,
+                "definition": definition_file_path,
+                "wall_time": None,
+                "steps": self.__steps,
+            }
+        )
+
+    def end(self, wall_time):
+        self.images[-1]["wall_time"] = round(wall_time, 1)
+
+    def __step(self, stage, instruction):
+        if instruction.upper().startswith("FROM "):
+            instruction = "FROM"
+        instruction = _normalize(instruction)
+        candidates = [x for x in self.__steps if x["instruction"] == instruction]
+        for step in candidates:
+            if step["stage"] == stage and "status" not in step:
+                return step
+        return candidates[0] if candidates else None
+
+    def parse(self, line):
+        """Parses one line of the build output"""
+        line = line.rstrip("\n")
+        self.__parse_step(line)
+        # Not the echoed RUN instruction which contains the marker in sed
+        match = re.search(rf"(?:^|\s){STATS_MARKER} (\S+) (.*)$", line)
+        if not match:
+            return
+        name, stat = match.groups()
+        if "\t" in stat:
+            # ccache --print-stats
+            key, value = stat.split("\t", 1)
+        else:
+            stat_match = re.match(r"(.+?)\s{2,}(.+)$", stat.strip())
+            if not stat_match:
+                return
+            key, value = stat_match.groups()
+            key = SHOW_STATS_KEYS.get(key, key)
+        value = value.strip()
+        if value.isdigit():
+            value = int(value)
+        self.ccache.setdefault(name, {})[key.strip()] = value
+
+    def __parse_step(self, line):
+        vertex = _vertex_re.match(line)
+        if vertex:
+            number, stage, instruction = vertex.groups()
+            if number not in self.__vertices:
+                step = self.__step(stage, instruction)
+                if step is not None:
+                    step["status"] = "started"
+                    self.__vertices[number] = step
+            return
+        for regex, status in [
+            (_done_re, "done"),
+            (_cached_re, "cached"),
+            (_error_re, "error"),
+        ]:
+            match = regex.match(line)
+            if match and match.group(1) in self.__vertices:
+                step = self.__vertices[match.group(1)]
+                step["status"] = status
+                if status == "done":
+                    step["duration"] = float(match.group(2))
+                return
+
+    def add_history(self, layers):
+        """Attributes the layer sizes of the image history (see
+        docker_history() and archive_history()) to the steps of the last
+        build"""
+        assigned = set()
+        unattributed = 0
+        for size, created_by in layers:
+            created_by = re.sub(r" # buildkit$", "", created_by.strip())
+            keyword, _, arguments = created_by.partition(" ")
+            if keyword == "RUN":
+                # Build arguments and the shell
+                arguments = re.sub(r"^\|\d+ (\S+=\S* )*", "", arguments)
+                arguments = re.sub(r"^/bin/(ba)?sh -c ", "", arguments)
+            key = _normalize(f"{keyword} {arguments}")
+            step = None
+            for index in reversed(range(len(self.__steps))):
+                candidate = self.__steps[index]
+                if (
+                    index not in assigned
+                    and _instruction_key(candidate["instruction"]) == key
+                ):
+                    step = candidate
+                    assigned.add(index)
+                    break
+            if step is None:
+                unattributed += size
+            else:
+                step["size"] = size
+        self.images[-1]["unattributed_size"] = unattributed
+        self.images[-1]["size"] = sum(x[0] for x in layers)
+
+    def sizes(self, image=-1):
+        """Size per building block of the image (default: the last one),
+        largest first"""
+        image = self.images[image]
+        sizes = {}
+        for step in image["steps"]:
+            key = (step["recipe"], step["block"])
+            sizes[key] = sizes.get(key, 0) + step.get("size", 0)
+        if image.get("unattributed_size"):
+            sizes[("", UNATTRIBUTED)] = image["unattributed_size"]
+        return sorted(
+            [
+                {"recipe": recipe, "block": block, "size": size}
+                for (recipe, block), size in sizes.items()
+                if size
+            ],
+            key=lambda x: -x["size"],
+        )
+
+    def size_table(self, image=-1):
+        total = self.images[image].get("size", 0)
+        lines = [
+            f"Size of image `{self.images[image]['tag']}`: {total / 1e6:.1f} MB",
+            "",
+            "| Recipe | Block | Size [MB] | Share |",
+            "| --- | --- | ---: | ---: |",
+        ]
+        for block in self.sizes(image):
+            lines.append(
+                "| {} | {} | {:.1f} | {:.1f} % |".format(
+                    block["recipe"],
+                    block["block"].replace("|", "\\|"),
+                    block["size"] / 1e6,
+                    100 * block["size"] / total if total else 0,
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+    def check_budgets(self, budgets):
+        """Returns the exceeded size budgets of the last image. budgets are
+        given as SIZE (whole image) or BLOCK=SIZE where BLOCK matches (case
+        insensitive) a part of the block name, e.g. openmpi=300MB."""
+        exceeded = []
+        for budget in budgets:
+            name, _, size = budget.rpartition("=")
+            limit = parse_size(size)
+            if not name:
+                total = self.images[-1].get("size", 0)
+                if total > limit:
+                    exceeded.append(f"Image size {total / 1e6:.1f} MB exceeds {size}")
+                continue
+            blocks = [x for x in self.sizes() if name.lower() in x["block"].lower()]
+            for block in blocks:
+                if block["size"] > limit:
+                    exceeded.append(
+                        f"Size of {block['block']} ({block['recipe']}) "
+                        f"{block['size'] / 1e6:.1f} MB exceeds {size}"
+                    )
+        return exceeded
+
+    def blocks(self):
+        """Wall time, cache hits and misses and size per building block"""
+        blocks = {}
+        for image in self.images:
+            entries = [(x["recipe"], x["block"], x) for x in image["steps"]]
+            if image.get("unattributed_size"):
+                entries.append(("", UNATTRIBUTED, {"size": image["unattributed_size"]}))
+            for recipe, name, step in entries:
+                block = blocks.setdefault(
+                    (recipe, name),
+                    {
+                        "recipe": recipe,
+                        "block": name,
+                        "steps": 0,
+                        "cached": 0,
+                        "executed": 0,
+                        "wall_time": 0.0,
+                        "size": 0,
+                    },
+                )
+                block["size"] += step.get("size", 0)
+                status = step.get("status")
+                if status is None:
+                    continue
+                block["steps"] += 1
+                block["cached" if status == "cached" else "executed"] += 1
+                block["wall_time"] = round(
+                    block["wall_time"] + step.get("duration", 0.0), 1
+                )
+        return sorted(
+            [x for x in blocks.values() if x["steps"] or x["size"]],
+            key=lambda x: (-x["wall_time"], -x["size"]),
+        )
+
+    def summary(self):
+        """Hits, misses and hit rate of each ccache enabled build"""
+        summary = {}
+        for name, stats in self.ccache.items():
+            hits = stats.get("direct_cache_hit", 0) + stats.get(
+                "preprocessed_cache_hit", 0
+            )
+            misses = stats.get("cache_miss", 0)
+            summary[name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+                "stats": stats,
+            }
+        return summary
+
+    def markdown(self):
+        lines = []
+        for image in self.images:
+            lines.append(f"Image `{image['tag']}`: {image['wall_time']} s")
+        lines.extend(
+            [
+                "",
+                "| Recipe | Block | Steps | Cached | Wall time [s] | Size [MB] |",
+                "| --- | --- | ---: | ---: | ---: | ---: |",
+            ]
+        )
+        for block in self.blocks():
+            lines.append(
+                "| {} | {} | {} | {} | {} | {:.1f} |".format(
+                    block["recipe"],
+                    block["block"].replace("|", "\\|"),
+                    block["steps"],
+                    block["cached"],
+                    block["wall_time"],
+                    block["size"] / 1e6,
+                )
+            )
+        for index, image in enumerate(self.images):
+            if "size" in image:
+                lines.extend(["", self.size_table(index).rstrip("\n")])
+        if self.ccache:
+            lines.extend(
+                [
+                    "",
+                    "| ccache | Hits | Misses | Hit rate |",
+                    "| --- | ---: | ---: | ---: |",
+                ]
+            )
+            for name, stats in sorted(self.summary().items()):
+                lines.append(
+                    f"| {name} | {stats['hits']} | {stats['misses']} | "
+                    f"{stats['hit_rate']} |"
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the report as JSON (path) and Markdown (.json replaced by
+        .md), returns False if there is nothing to report"""
+        if not self.images and not self.ccache:
+            return False
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "blocks": self.blocks(),
+                    "ccache": self.summary(),
+                    "images": self.images,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+        with open(re.sub(r"\.json$", ".md", path), "w") as f:
+            f.write(self.markdown())
+        return True
@@ -0,0 +1,179 @@
+"""Comparison of the squashfs compression profiles (ogscm bench-squash)
+
+The image is unpacked once (like for --convert-enroot) and squashed with each
+profile. Measured are the creation time, the file size and the sequential
+(all files in order) and random (blocks at random offsets) read throughput
+of the image mounted with squashfuse, as enroot does on the compute nodes.
+Each read benchmark runs on a fresh mount, i.e. all blocks are decompressed
+on first access. The squashfs file itself may still be in the page cache
+of the host, so the reads measure the decompression, not the file system
+the image file is on.
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from ogscm.app.converter import (
+    SQUASH_PROFILES,
+    converter,
+    remove_rootfs,
+    squash_options,
+)
+
+MB = 1000 * 1000
+
+
+class squash_bench(object):
+    def __init__(self, image, work_dir, profiles, **kwargs):
+        """image is an image archive (docker save or OCI archive) or the tag
+        of a local Docker image. profiles maps the profile names to their
+        mksquashfs options."""
+        self.__image = image
+        self.__work_dir = os.path.abspath(work_dir)
+        self.__profiles = profiles
+        self.__keep = kwargs.get("keep", False)
+        self.__random_reads = kwargs.get("random_reads", 2000)
+        self.__block_size = kwargs.get("block_size", 64 * 1024)
+        self.__files = []  # (path relative to the root, size)
+        self.results = []
+
+    def run(self):
+        os.makedirs(self.__work_dir, exist_ok=True)
+        archive = self.__image
+        if not os.path.isfile(archive):
+            archive = f"{self.__work_dir}/.bench-squash.tar"
+            print(f"Exporting {self.__image} ...")
+            subprocess.run(
+                f"docker save -o {archive} {self.__image}", shell=True, check=True
+            )
+        rootfs = tempfile.mkdtemp(prefix=".rootfs-", dir=self.__work_dir)
+        try:
+            print(f"Unpacking {archive} ...")
+            converter(archive, self.__work_dir).unpack(rootfs)
+            self.__files = self.__regular_files(rootfs)
+            for profile, options in self.__profiles.items():
+                self.results.append(self.__bench(rootfs, profile, options))
+        finally:
+            remove_rootfs(rootfs)
+            if archive != self.__image:
+                os.remove(archive)
+        return self.results
+
+    def __regular_files(self, rootfs):
+        files = []
+        for root, dirs, names in os.walk(rootfs):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    files.append((os.path.relpath(path, rootfs), os.path.getsize(path)))
+        return files
+
+    def __bench(self, rootfs, profile, options):
+        name = os.path.basename(self.__image).split(".tar")[0].replace(":", "-")
+        sqsh_file = f"{self.__work_dir}/{name}-{profile}.sqsh"
+        print(f"Squashing with {profile} ({options}) ...")
+        start = time.perf_counter()
+        subprocess.run(
+            f"rm -f {sqsh_file} && mksquashfs {rootfs} {sqsh_file} -all-root "
+            f"-no-progress {options}",
+            shell=True,
+            check=True,
+        )
+        result = {
+            "profile": profile,
+            "options": options,
+            "create_time": time.perf_counter() - start,
+            "size": os.path.getsize(sqsh_file),
+        }
+        result["sequential_read"] = self.__mounted(sqsh_file, self.__read_sequential)
+        result["random_read"] = self.__mounted(sqsh_file, self.__read_random)
+        if not self.__keep:
+            os.remove(sqsh_file)
+        return result
+
+    def __mounted(self, sqsh_file, read):
+        """Throughput in bytes / s of read(mount point) on a fresh mount"""
+        mount_point = tempfile.mkdtemp(prefix=".mnt-", dir=self.__work_dir)
+        subprocess.run(f"squashfuse {sqsh_file} {mount_point}", shell=True, check=True)
+        try:
+            start = time.perf_counter()
+            size = read(mount_point)
+            return size / max(time.perf_counter() - start, 1e-9)
+        finally:
+            fusermount = shutil.which("fusermount3") or "fusermount"
+            subprocess.run(f"{fusermount} -u {mount_point}", shell=True, check=True)
+            os.rmdir(mount_point)
+
+    def __read_sequential(self, mount_point):
+        size = 0
+        for path, _ in self.__files:
+            with open(os.path.join(mount_point, path), "rb") as f:
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+        return size
+
+    def __read_random(self, mount_point):
+        files = [x for x in self.__files if x[1] > 0]
+        if not files:
+            return 0
+        # The same reads for all profiles
+        generator = random.Random(0)
+        reads = generator.choices(
+            files, weights=[x[1] for x in files], k=self.__random_reads
+        )
+        size = 0
+        for path, file_size in reads:
+            offset = generator.randrange(max(file_size - self.__block_size, 0) + 1)
+            fd = os.open(os.path.join(mount_point, path), os.O_RDONLY)
+            try:
+                size += len(os.pread(fd, self.__block_size, offset))
+            finally:
+                os.close(fd)
+        return size
+
+    def table(self):
+        """The results as Markdown table"""
+        uncompressed = sum(x[1] for x in self.__files)
+        lines = [
+            "| Profile | Options | Create [s] | Size [MB] | Ratio "
+            "| Sequential read [MB/s] | Random read [MB/s] |",
+            "| --- | --- | ---: | ---: | ---: | ---: | ---: |",
+        ]
+        for result in self.results:
+            ratio = uncompressed / result["size"] if result["size"] else 0.0
+            lines.append(
+                f"| {result['profile']} | `{result['options']}` "
+                f"| {result['create_time']:.1f} | {result['size'] / MB:.1f} "
+                f"| {ratio:.2f} | {result['sequential_read'] / MB:.1f} "
+                f"| {result['random_read'] / MB:.1f} |"
+            )
+        return "\n".join(lines)
+
+    def write(self, path):
+        with open(path, "w") as fp:
+            json.dump(
+                {
+                    "image": self.__image,
+                    "uncompressed_size": sum(x[1] for x in self.__files),
+                    "results": self.results,
+                },
+                fp,
+                indent=2,
+            )
+
+
+def profiles(names=None, custom_options=""):
+    """The profiles to compare: the given names or all predefined ones and,
+    with custom_options, custom"""
+    if not names:
+        names = list(SQUASH_PROFILES) + (["custom"] if custom_options else [])
+    return {x: squash_options(x, custom_options) for x in names}
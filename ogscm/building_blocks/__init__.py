@@ -1,9 +1,13 @@
 from __future__ import absolute_import
 
+from ogscm.building_blocks.build_jobs import build_jobs
 from ogscm.building_blocks.ccache import ccache
+from ogscm.building_blocks.dependency_stages import dependency_stages
+from ogscm.building_blocks.library_closure import library_closure
 from ogscm.building_blocks.lmod import lmod
 from ogscm.building_blocks.ogs import ogs
 from ogscm.building_blocks.ogs_base import ogs_base
 from ogscm.building_blocks.osu_benchmarks import osu_benchmarks
 from ogscm.building_blocks.paraview import paraview
 from ogscm.building_blocks.pm_easybuild import pm_easybuild
+from ogscm.building_blocks.slim import slim
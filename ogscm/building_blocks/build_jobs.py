@@ -0,0 +1,118 @@
+# pylint: disable=invalid-name, too-few-public-methods
+# pylint: disable=too-many-instance-attributes
+"""build jobs building block"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from hpccm.building_blocks.base import bb_base
+from hpccm.primitives.comment import comment
+from hpccm.primitives.shell import shell
+
+
+class build_jobs(bb_base):
+    """The `build_jobs` building block installs a script which prints the
+    number of parallel compile (`build-jobs compile`) and link jobs
+    (`build-jobs link`) and the load limit (`build-jobs load`). These are
+    derived at build time from the available cores and memory, taking cgroup
+    limits into account.
+
+    # Parameters
+
+    compile_memory: The memory in MiB one compile job needs. The default
+    value is `2048`.
+
+    link_memory: The memory in MiB one link job needs. The default value is
+    `8192`.
+
+    path: The install location of the script. The default value is
+    `/usr/local/bin/build-jobs`.
+
+    # Examples
+
+    ```python
+    jobs = build_jobs()
+    Stage0 += jobs
+    Stage0 += generic_cmake(
+        cmake_opts=jobs.cmake_args(), parallel=jobs.parallel(), ...
+    )
+    ```
+
+    """
+
+    def __init__(self, **kwargs):
+        """Initialize building block"""
+        super(build_jobs, self).__init__()
+
+        self.__compile_memory = kwargs.get("compile_memory", 2048)
+        self.__link_memory = kwargs.get("link_memory", 8192)
+        self.__path = kwargs.get("path", "/usr/local/bin/build-jobs")
+
+        self.__instructions()
+
+    def __instructions(self):
+        self += comment(__doc__, reformat=False)
+        script = [
+            "#!/bin/sh",
+            "# Usage: build-jobs compile|link|load",
+            "cores=$(nproc)",
+            "if [ -f /sys/fs/cgroup/cpu.max ]; then",
+            "  read quota period < /sys/fs/cgroup/cpu.max",
+            "elif [ -f /sys/fs/cgroup/cpu/cpu.cfs_quota_us ]; then",
+            "  quota=$(cat /sys/fs/cgroup/cpu/cpu.cfs_quota_us)",
+            "  period=$(cat /sys/fs/cgroup/cpu/cpu.cfs_period_us)",
+            "fi",
+            'if [ -n "$quota" ] && [ "$quota" != max ] && [ "$quota" -gt 0 ]; then',
+            "  quota_cores=$(( (quota + period - 1) / period ))",
+            '  [ "$quota_cores" -lt "$cores" ] && cores=$quota_cores',
+            "fi",
+            "# Available memory in MiB",
+            "while read key value unit; do",
+            '  [ "$key" = MemAvailable: ] && memory=$((value / 1024))',
+            "done < /proc/meminfo",
+            "for cgroup in /sys/fs/cgroup/memory.max:/sys/fs/cgroup/memory.current "
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes:"
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes; do",
+            "  limit=${cgroup%:*}; usage=${cgroup#*:}",
+            '  [ -f "$limit" ] && [ -f "$usage" ] || continue',
+            '  [ "$(cat $limit)" = max ] && continue',
+            "  available=$(( ($(cat $limit) - $(cat $usage)) / 1048576 ))",
+            '  [ "$available" -lt "$memory" ] && memory=$available',
+            "done",
+            f"compile=$((memory / {self.__compile_memory}))",
+            '[ "$compile" -gt "$cores" ] && compile=$cores',
+            '[ "$compile" -lt 1 ] && compile=1',
+            f"link=$((memory / {self.__link_memory}))",
+            '[ "$link" -gt "$compile" ] && link=$compile',
+            '[ "$link" -lt 1 ] && link=1',
+            'case "$1" in',
+            "  compile) echo $compile ;;",
+            "  link) echo $link ;;",
+            "  load) echo $cores ;;",
+            '  *) echo "Usage: $0 compile|link|load" >&2; exit 1 ;;',
+            "esac",
+        ]
+        self += shell(
+            commands=[
+                "printf '%s\\n' {} > {}".format(
+                    " ".join(f"'{line}'" for line in script), self.__path
+                ),
+                f"chmod +x {self.__path}",
+            ]
+        )
+
+    def parallel(self):
+        """The parallel argument for CMake / Make builds, e.g. -j<parallel>"""
+        return f"$({self.__path} compile) -l$({self.__path} load)"
+
+    def cmake_args(self):
+        """CMake arguments for separate Ninja compile and link job pools"""
+        return [
+            f'-DCMAKE_JOB_POOLS="compile=$({self.__path} compile);'
+            f'link=$({self.__path} link)"',
+            "-DCMAKE_JOB_POOL_COMPILE=compile",
+            "-DCMAKE_JOB_POOL_LINK=link",
+        ]
+
+    # No runtime
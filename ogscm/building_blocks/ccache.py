@@ -6,13 +6,21 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from __future__ import print_function
 
-from hpccm.building_blocks.base import bb_base
+import re
+
+import hpccm.config
+
+from hpccm.building_blocks.base import bb_base, bb_instructions
+from hpccm.common import linux_distro
 from hpccm.building_blocks.packages import packages
 from hpccm.primitives.comment import comment
 from hpccm.primitives.environment import environment
 from hpccm.primitives.label import label
 from hpccm.primitives.shell import shell
 
+# Prefix of the ccache statistics lines in the build output
+STATS_MARKER = "ogscm-ccache-stats"
+
 
 class ccache(bb_base):
     """ccache building block"""
@@ -42,4 +50,55 @@ class ccache(bb_base):
             metadata={"ccache.dir": self.__cache_dir, "ccache.size": self.__cache_size}
         )
 
+    def launcher_args(self):
+        """CMake arguments to build through ccache"""
+        return [
+            "-DCMAKE_C_COMPILER_LAUNCHER=ccache",
+            "-DCMAKE_CXX_COMPILER_LAUNCHER=ccache",
+        ]
+
+    def enable(self, block, name, masquerade=False):
+        """Adds a cache mount (with id ccache-<name>) and statistics to the
+        compile step of the given building block. The statistics are reset
+        before and printed after compiling, each line prefixed with
+        STATS_MARKER and name. With masquerade the compilers are found via
+        ccache symlinks in the PATH, e.g. for autotools builds."""
+        step = self.__compile_step(block)
+        if step is None:
+            return block
+        commands = ["ccache --zero-stats"]
+        if masquerade:
+            ccache_bin = "/usr/lib/ccache"
+            if hpccm.config.g_linux_distro == linux_distro.CENTOS:
+                ccache_bin = "/usr/lib64/ccache"
+            commands.append(f"export PATH={ccache_bin}:$PATH")
+        step.commands = (
+            commands
+            + step.commands
+            + [
+                # --print-stats (machine-readable) requires ccache 4
+                "(ccache --print-stats 2>/dev/null || ccache --show-stats) | "
+                f"sed 's/^/{STATS_MARKER} {name} /'"
+            ]
+        )
+        arguments = step._arguments or ""
+        if f"target={self.__cache_dir}" not in arguments:
+            step._arguments = (
+                f"{arguments} --mount=type=cache,id=ccache-{name},"
+                f"target={self.__cache_dir}"
+            ).strip()
+        return block
+
+    def __compile_step(self, instructions):
+        for instruction in instructions:
+            if isinstance(instruction, bb_instructions):
+                step = self.__compile_step(instruction)
+                if step is not None:
+                    return step
+            elif isinstance(instruction, shell) and re.search(
+                r"cmake --build|\bmake -j", "\n".join(instruction.commands)
+            ):
+                return instruction
+        return None
+
     # No runtime
@@ -0,0 +1,106 @@
+# pylint: disable=invalid-name, too-few-public-methods
+# pylint: disable=too-many-instance-attributes
+"""dependency stages building block"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import posixpath
+
+from hpccm.building_blocks.base import bb_base, bb_instructions
+from hpccm.primitives.comment import comment
+from hpccm.primitives.copy import copy
+from hpccm.primitives.environment import environment
+from hpccm.primitives.raw import raw
+from hpccm.primitives.shell import shell
+
+
+class dependency_stages(bb_base):
+    """The `dependency_stages` building block builds each third-party
+    dependency in its own named stage and copies the install prefixes
+    into a common stage afterwards. BuildKit builds the independent
+    dependency stages concurrently (Docker-only).
+
+    # Parameters
+
+    base: The name of the stage the dependency stages are built from.
+    The default value is `build`.
+
+    name: The name of the stage the install prefixes are copied into.
+    The default value is `ogs`.
+
+    stages: List of dictionaries with the keys `name` (stage name),
+    `block` (building block to build) and `prefix` (install location).
+    Optional keys are `base` (stage to build from instead of `base`),
+    `libdir` (library directory relative to `prefix`, default `lib`)
+    and `runtime` (include the block in the runtime, default `True`).
+
+    # Examples
+
+    ```python
+    dependency_stages(
+        stages=[
+            {"name": "eigen", "block": generic_cmake(...), "prefix": "/usr/local/eigen"},
+            {"name": "hdf5", "block": hdf5(...), "prefix": "/usr/local/hdf5"},
+        ]
+    )
+    ```
+
+    """
+
+    def __init__(self, **kwargs):
+        super(dependency_stages, self).__init__()
+
+        self.__base = kwargs.get("base", "build")
+        self.__name = kwargs.get("name", "ogs")
+        self.__stages = kwargs.get("stages", [])
+
+        self.__instructions()
+
+    def __instructions(self):
+        for stage in self.__stages:
+            self += raw(
+                docker="\nFROM {} AS {}".format(
+                    stage.get("base", self.__base), stage["name"]
+                )
+            )
+            self += stage["block"]
+
+        self += raw(docker="\nFROM {} AS {}".format(self.__base, self.__name))
+        for stage in self.__stages:
+            block = stage["block"]
+            prefix = stage["prefix"]
+            self += comment("{} from stage {}".format(prefix, stage["name"]))
+            self += copy(_from=stage["name"], src=prefix, dest=prefix)
+            # The build environment of the dependency stage is lost
+            self += self.__environment(block)
+            if getattr(block, "ldconfig", False):
+                self += shell(
+                    commands=[
+                        block.ldcache_step(
+                            directory=posixpath.join(prefix, stage.get("libdir", "lib"))
+                        )
+                    ]
+                )
+
+    def __environment(self, instructions):
+        """Collect the environment primitives of a (nested) building block"""
+        variables = []
+        for instruction in instructions:
+            if isinstance(instruction, environment):
+                variables.append(instruction)
+            elif isinstance(instruction, bb_instructions):
+                variables.extend(self.__environment(instruction))
+        return variables
+
+    def runtime(self, _from="0", exclude=()):
+        """exclude: Building block instances whose runtime is skipped"""
+        instructions = []
+        for stage in self.__stages:
+            runtime = getattr(stage["block"], "runtime", None)
+            if any(stage["block"] is x for x in exclude):
+                continue
+            if callable(runtime) and stage.get("runtime", True):
+                instructions.append(runtime(_from=_from))
+        return "\n".join(x for x in instructions if x)
@@ -0,0 +1,110 @@
+# pylint: disable=invalid-name, too-few-public-methods
+# pylint: disable=too-many-instance-attributes
+"""library closure building block"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from hpccm.building_blocks.base import bb_base
+from hpccm.primitives.comment import comment
+from hpccm.primitives.copy import copy
+from hpccm.primitives.raw import raw
+from hpccm.primitives.shell import shell
+
+# Provided by the C library of the runtime base image
+SYSTEM_LIBRARIES = [
+    "ld-linux[^/]*",
+    "libc",
+    "libdl",
+    "libm",
+    "libpthread",
+    "libresolv",
+    "librt",
+    "libutil",
+]
+
+
+class library_closure(bb_base):
+    """The `library_closure` building block adds a stage which collects the
+    shared libraries the ELF files (executables, libraries, Python modules)
+    in the given paths link to, resolved with `ldd`. The libraries are
+    copied with their full path (and symlink targets) to `dest`, the
+    library directories are added to the ld cache configuration. The
+    runtime stage then copies only these libraries instead of the complete
+    dependency install prefixes (Docker-only).
+
+    Libraries which are loaded with `dlopen()` (e.g. plugins) are not found.
+
+    # Parameters
+
+    base: The name of the stage to start from. The default value is `build`.
+
+    dest: The directory the libraries are collected in. The default value
+    is `/closure`.
+
+    name: The name of the stage. The default value is `closure`.
+
+    paths: List of paths (install prefixes or files) whose ELF files are
+    resolved.
+
+    strip: Strip the collected libraries. The default value is `False`.
+
+    # Examples
+
+    ```python
+    Stage0 += library_closure(paths=["/usr/local/ogs"])
+    Stage1 += library_closure.runtime(_from="closure")
+    ```
+
+    """
+
+    def __init__(self, **kwargs):
+        super(library_closure, self).__init__()
+
+        self.__base = kwargs.get("base", "build")
+        self.__dest = kwargs.get("dest", "/closure")
+        self.__name = kwargs.get("name", "closure")
+        self.__paths = kwargs.get("paths", [])
+        self.__strip = kwargs.get("strip", False)
+
+        self.__instructions()
+
+    def __instructions(self):
+        self += raw(docker="\nFROM {} AS {}".format(self.__base, self.__name))
+        self += comment(__doc__, reformat=False)
+        paths = " ".join(self.__paths)
+        system_libraries = "|".join(SYSTEM_LIBRARIES)
+        strip = ""
+        if self.__strip:
+            strip = f'strip --strip-unneeded "{self.__dest}$target" 2>/dev/null; '
+        self += shell(
+            commands=[
+                f"mkdir -p {self.__dest}/etc/ld.so.conf.d",
+                f"find {paths} -type f 2>/dev/null | while read -r f; do "
+                '[ "$(head -c 4 "$f" | tail -c 3)" = ELF ] || continue; '
+                "ldd \"$f\" 2>/dev/null | awk '/=> \\// {print $3}'; "
+                "done | sort -u | "
+                f"{{ grep -v -E '/({system_libraries})\\.so' || true; }} > /tmp/libraries",
+                # Canonical directories, e.g. /lib is a symlink to /usr/lib
+                "while read -r library; do "
+                'directory=$(readlink -f "$(dirname "$library")"); '
+                'target=$(readlink -f "$library"); '
+                f'mkdir -p "{self.__dest}$directory" "{self.__dest}$(dirname "$target")"; '
+                f'cp -a "$directory/$(basename "$library")" "{self.__dest}$directory/"; '
+                f'cp -a "$target" "{self.__dest}$(dirname "$target")/"; '
+                f"{strip}"
+                'echo "$directory"; '
+                f"done < /tmp/libraries | sort -u > "
+                f"{self.__dest}/etc/ld.so.conf.d/ogscm-closure.conf",
+                "rm /tmp/libraries",
+            ]
+        )
+
+    def runtime(self, _from="closure"):
+        instructions = [
+            comment("Shared libraries from stage {}".format(_from)),
+            copy(_from=_from, src=f"{self.__dest}/", dest="/"),
+            shell(commands=["ldconfig"]),
+        ]
+        return "\n".join(str(x) for x in instructions)
@@ -34,6 +34,8 @@ class ogs(bb_base, hpccm.templates.CMakeBuild, hpccm.templates.rm):
         super(ogs, self).__init__(**kwargs)
 
         self.__cmake_args = kwargs.get("cmake_args", [])
+        # Additional CMake options which are not recorded in the label
+        self.__cmake_opts = kwargs.get("cmake_opts", [])
         self.__cmake_preset = kwargs.get("cmake_preset", "release")
         self.__cmake_preset_file = kwargs.get("cmake_preset_file", None)
         self.__ospackages = []
@@ -139,7 +141,7 @@ class ogs(bb_base, hpccm.templates.CMakeBuild, hpccm.templates.rm):
             self.configure_step(
                 directory="{}/src".format(self.__prefix),
                 build_directory=build_directory,
-                opts=self.__cmake_args,
+                opts=self.__cmake_args + self.__cmake_opts,
                 toolchain=self.__toolchain,
             )
         )
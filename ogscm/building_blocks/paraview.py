@@ -112,6 +112,7 @@ class paraview(
         self += generic_cmake(
             branch=self.__version,
             cmake_opts=self.__cmake_args,
+            parallel=self.__parallel,
             prefix=self.__prefix,
             toolchain=self.__toolchain,
             recursive=True,
@@ -0,0 +1,86 @@
+# pylint: disable=invalid-name, too-few-public-methods
+# pylint: disable=too-many-instance-attributes
+"""slim building block"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from hpccm.building_blocks.base import bb_base
+from hpccm.primitives.comment import comment
+from hpccm.primitives.copy import copy
+from hpccm.primitives.raw import raw
+from hpccm.primitives.shell import shell
+
+
+class slim(bb_base):
+    """The `slim` building block adds a stage which prepares the paths
+    copied into the runtime stage: headers (`include/`), static libraries
+    (`*.a`) and CMake config files (`lib/cmake`) are removed and ELF files
+    are stripped. The runtime stage then copies from this stage
+    (Docker-only).
+
+    # Parameters
+
+    base: The name of the stage to start from. The default value is `build`.
+
+    debug: Keep the debug symbols in `/usr/lib/debug` (linked with
+    `--add-gnu-debuglink`) and add a `debug` stage containing only these.
+    The default value is `False`.
+
+    name: The name of the stage. The default value is `slim`.
+
+    paths: List of paths (install prefixes or files) to slim.
+
+    # Examples
+
+    ```python
+    slim(paths=["/usr/local/ogs", "/usr/local/vtk"])
+    ```
+
+    """
+
+    def __init__(self, **kwargs):
+        super(slim, self).__init__()
+
+        self.__base = kwargs.get("base", "build")
+        self.__debug = kwargs.get("debug", False)
+        self.__name = kwargs.get("name", "slim")
+        self.__paths = kwargs.get("paths", [])
+        self.debug_dir = "/usr/lib/debug"
+
+        self.__instructions()
+
+    def __instructions(self):
+        self += raw(docker="\nFROM {} AS {}".format(self.__base, self.__name))
+        self += comment(__doc__, reformat=False)
+        paths = " ".join(self.__paths)
+        if self.__debug:
+            strip = (
+                'mkdir -p {0}$(dirname "$f") && '
+                'objcopy --only-keep-debug "$f" "{0}$f.debug" && '
+                'strip --strip-unneeded "$f" && '
+                'objcopy --add-gnu-debuglink="{0}$f.debug" "$f"'.format(self.debug_dir)
+            )
+        else:
+            strip = 'strip --strip-unneeded "$f"'
+        commands = []
+        if self.__debug:
+            commands.append(f"mkdir -p {self.debug_dir}")
+        self += shell(
+            commands=commands
+            + [
+                f"for path in {paths}; do "
+                '[ -d "$path" ] || continue; '
+                'rm -rf "$path/include" "$path/lib/cmake" "$path/lib64/cmake"; '
+                "find \"$path\" -type f -name '*.a' -delete; "
+                "done",
+                f"find {paths} -type f 2>/dev/null | while read -r f; do "
+                '[ "$(head -c 4 "$f" | tail -c 3)" = ELF ] || continue; '
+                f'({strip}) 2>/dev/null || echo "Not stripped: $f"; '
+                "done",
+            ]
+        )
+        if self.__debug:
+            self += raw(docker="\nFROM scratch AS debug")
+            self += copy(_from=self.__name, src=self.debug_dir, dest=self.debug_dir)
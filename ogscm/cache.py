@@ -0,0 +1,106 @@
+"""On-disk cache for HTTP lookups, e.g. of versions.json files on GitLab
+
+Responses are stored per URL in ``<config.g_cache_dir>/http``. An entry is
+served as is while it is younger than ``config.g_cache_ttl``; afterwards it
+is revalidated with its ETag (``If-None-Match``). In offline mode only cached
+entries are served.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import requests
+
+from ogscm import config, profiling
+
+
+def _entry_path(url):
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(config.g_cache_dir, "http", f"{url_hash}.json")
+
+
+def _read(url):
+    path = _entry_path(url)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r") as fp:
+            entry = json.load(fp)
+    except ValueError:
+        return None  # Corrupt entry, e.g. from an interrupted write
+    if entry.get("url") != url:
+        return None
+    return entry
+
+
+def _write(url, entry):
+    path = _entry_path(url)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write atomically, concurrent ogscm processes and threads may share
+        # the cache.
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    except OSError as err:
+        # E.g. a read-only home directory, continue without caching
+        print(f"WARNING: Can not write the cache entry of {url}: {err}")
+        return
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(entry, fp)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        os.remove(tmp_path)
+        print(f"WARNING: Can not write the cache entry of {url}: {err}")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get(url, session=None, timeout=None):
+    """Returns the body of the response to a GET request of url.
+
+    Raises RuntimeError in offline mode when url is not cached and
+    requests.HTTPError on unsuccessful responses (which are not cached).
+    """
+    entry = _read(url)
+    if entry is not None and (
+        config.g_offline or time.time() - entry["time"] < config.g_cache_ttl
+    ):
+        return entry["text"]
+    if config.g_offline:
+        raise RuntimeError(f"{url} is not cached, can not fetch it in offline mode!")
+
+    headers = {}
+    if entry is not None and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    http = session if session is not None else requests
+    try:
+        with profiling.timer("network", url):
+            response = http.get(url, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as err:
+        if entry is None:
+            raise
+        print(f"WARNING: {err.__class__.__name__} for {url}, using cached response.")
+        return entry["text"]
+
+    if response.status_code == 304 and entry is not None:
+        entry["time"] = time.time()
+        _write(url, entry)
+        return entry["text"]
+    response.raise_for_status()
+
+    _write(
+        url,
+        {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "time": time.time(),
+            "text": response.text,
+        },
+    )
+    return response.text
@@ -0,0 +1,95 @@
+"""BuildKit cache mounts for the RUN instructions of a stage (Docker-only).
+
+apt archives are kept in /var/cache/apt, pip wheels in /root/.cache/pip and
+downloaded source tarballs in /var/tmp. Building blocks downloading sources
+additionally get their own ccache directory mounted to /opt/ccache.
+"""
+
+import hashlib
+import posixpath
+import re
+
+from hpccm.building_blocks.base import bb_instructions
+from hpccm.primitives.shell import shell
+
+APT_MOUNT = "--mount=type=cache,target=/var/cache/apt,sharing=locked"
+PIP_MOUNT = "--mount=type=cache,target=/root/.cache/pip"
+
+# The Debian and Ubuntu base images delete downloaded packages after install
+APT_KEEP_DOWNLOADS = [
+    "rm -f /etc/apt/apt.conf.d/docker-clean",
+    "echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' > "
+    "/etc/apt/apt.conf.d/keep-cache",
+]
+
+_apt_re = re.compile(r"\bapt-get (install|download)\b")
+_pip_re = re.compile(r"\bpip[\d.]* .*\binstall\b")
+_download_re = re.compile(r"\bwget .*-P /var/tmp (\S+)")
+
+
+def download_name(url):
+    """Name of a download without version, e.g. vtk for VTK-9.1.0.tar.gz"""
+    if "/archive/" in url:
+        # e.g. https://github.com/ufz/cvode/archive/2.8.2.tar.gz
+        return posixpath.basename(url.split("/archive/")[0].rstrip("/-")).lower()
+    name = re.split(r"[-_.]v?\d", posixpath.basename(url))[0].lower()
+    if not name:
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+    return name
+
+
+def _keep_downloads(command, downloads):
+    """Removes downloaded files from a cleanup step"""
+    if not command.startswith("rm -rf "):
+        return command
+    files = [posixpath.join("/var/tmp", posixpath.basename(x)) for x in downloads]
+    items = [x for x in command.split()[2:] if x not in files]
+    if not items:
+        return ""
+    return "rm -rf {}".format(" ".join(items))
+
+
+def _add_mounts(primitive, mounts):
+    current = primitive._arguments or ""
+    arguments = [current.strip()] if current.strip() else []
+    for mount in mounts:
+        target = re.search(r"target=([^,]*)", mount).group(1)
+        if f"target={target}" not in current:
+            arguments.append(mount)
+    primitive._arguments = " ".join(arguments)
+
+
+def add(instructions, apt_configured=False):
+    """Adds cache mounts to all RUN instructions of the given stage or
+    building block. Returns True if apt was configured to keep downloaded
+    packages."""
+    # Stages do not expose their layers
+    layers = getattr(instructions, "_Stage__layers", instructions)
+    for layer in layers:
+        if isinstance(layer, bb_instructions):
+            apt_configured = add(layer, apt_configured)
+            continue
+        if not isinstance(layer, shell) or not layer.commands:
+            continue
+
+        text = "\n".join(layer.commands)
+        mounts = []
+        if _apt_re.search(text):
+            mounts.append(APT_MOUNT)
+            if not apt_configured:
+                layer.commands = APT_KEEP_DOWNLOADS + layer.commands
+                apt_configured = True
+        if _pip_re.search(text):
+            mounts.append(PIP_MOUNT)
+            layer.commands = [x.replace(" --no-cache-dir", "") for x in layer.commands]
+        downloads = _download_re.findall(text)
+        if downloads:
+            name = download_name(downloads[0])
+            mounts.append(
+                f"--mount=type=cache,id=var-tmp-{name},target=/var/tmp,sharing=locked"
+            )
+            mounts.append(f"--mount=type=cache,id=ccache-{name},target=/opt/ccache")
+            layer.commands = [_keep_downloads(x, downloads) for x in layer.commands]
+        if mounts:
+            _add_mounts(layer, mounts)
+    return apt_configured
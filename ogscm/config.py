@@ -2,11 +2,17 @@
 
 from __future__ import absolute_import
 
+import os
 import sys
 
 from ogscm.common import package_manager
 
 g_package_manager = package_manager.SYSTEM
+g_cache_dir = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ogscm"
+)
+g_cache_ttl = 600  # seconds
+g_offline = False
 
 
 def set_package_manager(pm):
@@ -22,3 +28,15 @@ def set_package_manager(pm):
         this.g_package_manager = package_manager.OFF
     else:
         RuntimeError("Invalid package manager!")
+
+
+def set_cache_ttl(ttl):
+    """Seconds a cached HTTP response is used without revalidation"""
+    this = sys.modules[__name__]
+    this.g_cache_ttl = int(ttl)
+
+
+def set_offline(offline):
+    """Serve HTTP lookups from the cache only"""
+    this = sys.modules[__name__]
+    this.g_offline = bool(offline)
@@ -0,0 +1,906 @@
+"""Generation of container definitions from recipes
+
+Used by the ogscm command line tool and usable as API, e.g.:
+
+    import ogscm
+
+    definition = ogscm.generate(
+        recipes=["compiler.py", "ogs.py"],
+        options={"compiler": "clang", "ogs": "off", "runtime_only": True},
+    )
+    print(definition.text)
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import os
+import sys
+import traceback
+
+import ogscm.config
+import ogscm.lock
+import ogscm.profiling
+from ogscm.version import __version__
+
+# hpccm is imported lazily to keep e.g. `ogscm --version` fast.
+
+
+class _cpu_targets(object):
+    """archspec CPU microarchitectures, evaluated on first use"""
+
+    def __init__(self):
+        self.__targets = None
+
+    def __contains__(self, target):
+        return target in self.__get()
+
+    def __iter__(self):
+        return iter(self.__get())
+
+    def __get(self):
+        if self.__targets is None:
+            import archspec.cpu
+
+            self.__targets = sorted(archspec.cpu.TARGETS)
+        return self.__targets
+
+
+class _EvaluationError(RuntimeError):
+    """An error reported with fail() in generate()"""
+
+
+class _argument_parser(argparse.ArgumentParser):
+    """ArgumentParser which parses the given options instead of sys.argv.
+
+    Options are given as dict of option names (e.g. "cmake_args" or
+    "cpu-target") to values and are converted to command line arguments
+    whenever the parser is invoked, i.e. options of recipes are picked up
+    after the recipe added them. Errors raise a RuntimeError instead of
+    exiting.
+    """
+
+    def __init__(self, recipes, options, **kwargs):
+        super(_argument_parser, self).__init__(**kwargs)
+        self.__recipes = recipes
+        self.__options = options
+
+    def argv(self):
+        argv = list(self.__recipes)
+        for name, value in self.__options.items():
+            action = self.__find_action(name)
+            if action is None:
+                # Unknown (yet), passed as is to get an error in parse_args()
+                argv.append(f"--{name}={value}")
+            elif value is None or value is False:
+                continue
+            elif action.nargs == 0:
+                argv.append(action.option_strings[-1])
+            elif isinstance(value, (list, tuple)) and action.nargs is None:
+                # E.g. action="append", the option is repeated
+                argv.extend(f"{action.option_strings[-1]}={v}" for v in value)
+            elif isinstance(value, (list, tuple)):
+                argv.append(action.option_strings[-1])
+                argv.extend(str(v) for v in value)
+            else:
+                argv.append(f"{action.option_strings[-1]}={value}")
+        return argv
+
+    def parse_known_args(self, args=None, namespace=None):
+        if args is None:
+            args = self.argv()
+            # Drop options which are not added (by a recipe) yet
+            args = [a for a in args if not a.startswith("--") or self.__known(a)]
+        return super(_argument_parser, self).parse_known_args(args, namespace)
+
+    def parse_args(self, args=None, namespace=None):
+        if args is None:
+            args = self.argv()
+        return super(_argument_parser, self).parse_args(args, namespace)
+
+    def error(self, message):
+        raise RuntimeError(message)
+
+    def exit(self, status=0, message=None):
+        raise RuntimeError(message or f"Exited with status {status}")
+
+    def __find_action(self, name):
+        dest = name.replace("-", "_")
+        for action in self._actions:
+            if action.dest == dest or f"--{name}" in action.option_strings:
+                return action
+        return None
+
+    def __known(self, arg):
+        option = arg.split("=", 1)[0]
+        return any(option in action.option_strings for action in self._actions)
+
+
+def argument_parser(recipes=None, options=None):
+    """Returns the parser for the general arguments. Recipes add their own
+    arguments to it.
+
+    Without recipes and options sys.argv is parsed. Otherwise the given
+    options are parsed (see _argument_parser).
+    """
+    if recipes is None and options is None:
+        parser = argparse.ArgumentParser(add_help=False)
+    else:
+        parser = _argument_parser(recipes or [], options or {}, add_help=False)
+    parser.add_argument("recipe", nargs="+")
+
+    # General args
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s {version}".format(version=__version__),
+    )
+    parser.add_argument("--out", type=str, default="_out", help="Output directory")
+    parser.add_argument(
+        "--file", type=str, default="", help="Overwrite output recipe file name"
+    )
+    parser.add_argument(
+        "--print",
+        "-P",
+        dest="print",
+        action="store_true",
+        help="Print the definition to stdout",
+    )
+    parser.add_argument(
+        "--offline",
+        dest="offline",
+        action="store_true",
+        help="Serve network lookups (e.g. OGS versions) from the cache only",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        type=int,
+        default=600,
+        help="Seconds a cached network lookup is used before it is revalidated "
+        "(cache is in ~/.cache/ogscm)",
+    )
+    parser.add_argument(
+        "--lock",
+        type=str,
+        default="",
+        metavar="LOCKFILE",
+        help="Write everything resolved by the recipes (commits, versions) to "
+        "this lockfile",
+    )
+    parser.add_argument(
+        "--from-lock",
+        dest="from_lock",
+        type=str,
+        default="",
+        metavar="LOCKFILE",
+        help="Use the resolved values from this lockfile, no network or git "
+        "lookups are done",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Print the wall times of the recipes, network lookups, subprocess "
+        "calls and building block renders",
+    )
+    parser.add_argument(
+        "--profile-output",
+        dest="profile_output",
+        type=str,
+        default="",
+        metavar="FILE",
+        help="With --profile write a speedscope profile (*.json) or cProfile "
+        "statistics (other file names) to this file",
+    )
+    general_g = parser.add_argument_group("General image config")
+    general_g.add_argument(
+        "--format", type=str, choices=["docker", "singularity"], default="docker"
+    )
+    general_g.add_argument(
+        "--base_image",
+        type=str,
+        default="ubuntu:20.04",
+        help="The base image.",
+    )
+    general_g.add_argument(
+        "--runtime_base_image",
+        type=str,
+        default="",
+        help="The runtime base image.",
+    )
+    general_g.add_argument(
+        "--cpu-target",
+        type=str,
+        # https://github.com/archspec/archspec-json/blob/master/cpu/microarchitectures.json#L94
+        # Enables mmx, sse4_2, implemented by CPUs since around 2010.
+        default="ivybridge",
+        choices=_cpu_targets(),
+        metavar="CPU_TARGET",
+        help="The CPU microarchitecture to optimize for (archspec). Possible "
+        "options: %(choices)s",
+    )
+    general_g.add_argument(
+        "--cache-mounts",
+        dest="cache_mounts",
+        action="store_true",
+        help="Adds BuildKit cache mounts for apt, pip, source tarballs and ccache "
+        "to the RUN instructions. (Docker-only)",
+    )
+    build_g = parser.add_argument_group("Image build options")
+    build_g.add_argument(
+        "--build",
+        "-B",
+        dest="build",
+        action="store_true",
+        help="Build the images from the definition files",
+    )
+    build_g.add_argument(
+        "--build_args",
+        type=str,
+        default="",
+        help="Arguments to the build command. Have to be "
+        "quoted and **must** start with a space. E.g. "
+        "--build_args ' --no-cache'",
+    )
+    build_g.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        type=str,
+        default="",
+        help="Imports and exports the build cache of all stages from and to "
+        "this local directory (requires docker buildx)",
+    )
+    build_g.add_argument(
+        "--cache-ref",
+        dest="cache_ref",
+        type=str,
+        default="",
+        help="Imports and exports the build cache of all stages from and to "
+        "this registry image reference (requires docker buildx)",
+    )
+    build_g.add_argument(
+        "--upload",
+        "-U",
+        dest="upload",
+        action="store_true",
+        help="Upload Docker image to registry",
+    )
+    build_g.add_argument(
+        "--registry",
+        type=str,
+        default="registry.opengeosys.org/ogs/ogs",
+        help="The docker registry the image is tagged and " "uploaded to.",
+    )
+    build_g.add_argument(
+        "--tag",
+        type=str,
+        default="",
+        help="The full docker image tag. Overwrites --registry.",
+    )
+    build_g.add_argument(
+        "--size-budget",
+        dest="size_budget",
+        action="append",
+        default=[],
+        metavar="[BLOCK=]SIZE",
+        help="Fails the build if the image (SIZE, e.g. 3GB) or a building block "
+        "(BLOCK=SIZE, BLOCK matches a part of the block name as listed in the "
+        "build report, e.g. openmpi=300MB) is larger. Can be given multiple "
+        "times.",
+    )
+    build_g.add_argument(
+        "--convert",
+        "-C",
+        dest="convert",
+        action="store_true",
+        help="Convert Docker image to Singularity image",
+    )
+    build_g.add_argument(
+        "--sif_file",
+        type=str,
+        default="",
+        help="Overwrite output singularity image file name",
+    )
+    build_g.add_argument(
+        "--convert-enroot",
+        "-E",
+        dest="convert_enroot",
+        action="store_true",
+        help="Convert Docker image to enroot image",
+    )
+    build_g.add_argument(
+        "--enroot-bundle",
+        dest="enroot_bundle",
+        action="store_true",
+        help="Convert enroot image to enroot bundle",
+    )
+    build_g.add_argument(
+        "--enroot_file",
+        type=str,
+        default="",
+        help="Overwrite output enroot image file name",
+    )
+    build_g.add_argument(
+        "--squash-profile",
+        dest="squash_profile",
+        choices=["xz", "zstd", "lz4", "gzip", "custom"],
+        default="xz",
+        help="Compression of the enroot squashfs image, xz is the smallest, "
+        "lz4 the fastest to decompress; custom uses --squash-options. Compare "
+        "them on an image with `ogscm bench-squash`.",
+    )
+    build_g.add_argument(
+        "--squash-options",
+        dest="squash_options",
+        type=str,
+        default="",
+        help="mksquashfs options of --squash-profile custom, e.g. "
+        "'-comp zstd -Xcompression-level 19 -b 1M'",
+    )
+    build_g.add_argument(
+        "--convert-direct",
+        dest="convert_direct",
+        action="store_true",
+        help="Build the image into an OCI archive (docker buildx build --output "
+        "type=oci) and convert it from there instead of loading it into the "
+        "Docker daemon (requires a docker buildx builder with the "
+        "docker-container driver)",
+    )
+    build_g.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        help="Forces overwriting of image files!",
+    )
+    build_g.add_argument(
+        "--runtime-only",
+        "-R",
+        dest="runtime_only",
+        action="store_true",
+        help="Generate multi-stage Dockerfiles for small runtime " "images",
+    )
+    build_g.add_argument(
+        "--slim",
+        dest="slim",
+        action="store_true",
+        help="With --runtime-only strip the binaries and remove headers, static "
+        "libraries and CMake files before copying into the runtime stage. "
+        "(Docker-only)",
+    )
+    build_g.add_argument(
+        "--runtime-closure",
+        dest="runtime_closure",
+        action="store_true",
+        help="With --runtime-only copy only the shared libraries (resolved with "
+        "ldd) which OGS and the other runtime paths link to instead of the "
+        "complete install prefixes of VTK, ParaView, HDF5, PETSc, Boost, ... "
+        "(Docker-only)",
+    )
+    build_g.add_argument(
+        "--slim-debug",
+        dest="slim_debug",
+        action="store_true",
+        help="With --slim keep the debug symbols in a separate stage (debug); "
+        "with --build they are exported to [image]-debug.tar",
+    )
+    maint_g = parser.add_argument_group("Maintenance")
+    maint_g.add_argument(
+        "--clean",
+        dest="cleanup",
+        action="store_true",
+        help="Cleans up generated files in default directories.",
+    )
+    deploy_g = parser.add_argument_group("Image deployment")
+    deploy_g.add_argument(
+        "--deploy",
+        "-D",
+        nargs="?",
+        const="ALL",
+        type=str,
+        default="",
+        help="Deploys to all configured hosts (in config/deploy_hosts.yml) with no additional arguments or to the specified host. Implies --build and --convert arguments.",
+    )
+    deploy_g.add_argument(
+        "--deploy-jobs",
+        dest="deploy_jobs",
+        type=int,
+        default=4,
+        help="Number of hosts deployed to at once",
+    )
+    deploy_g.add_argument(
+        "--deploy-fanout",
+        dest="deploy_fanout",
+        choices=["tree", "chain"],
+        default="tree",
+        help="How the hosts with relay: true in config/deploy_hosts.yml relay "
+        "the image to the other hosts of their group: in a binomial tree or "
+        "in a chain",
+    )
+
+    install_g = parser.add_argument_group("Packages to install")
+    install_g.add_argument(
+        "--pip",
+        nargs="*",
+        type=str,
+        default=[],
+        metavar="package",
+        help="Install additional Python packages",
+    )
+    install_g.add_argument(
+        "--packages",
+        nargs="*",
+        type=str,
+        default=[],
+        metavar="packages",
+        help="Install additional OS packages",
+    )
+
+    return parser
+
+
+class Definition(object):
+    """A generated container definition"""
+
+    def __init__(self, **kwargs):
+        self.args = kwargs.get("args")
+        self.stage0 = kwargs.get("stage0", "")
+        self.stage1 = kwargs.get("stage1", "")
+        self.img_file = kwargs.get("img_file", "")
+        self.out_dir = kwargs.get("out_dir", "")
+        self.tag = kwargs.get("tag", "")
+        self.definition_file_path = kwargs.get("definition_file_path", "")
+        self.context = kwargs.get("context", os.getcwd())
+        # Definition of the dependencies image the definition starts from
+        self.deps = kwargs.get("deps", None)
+
+    @property
+    def text(self):
+        """The complete definition"""
+        if self.stage1:
+            return f"{self.stage0}\n\n{self.stage1}"
+        return self.stage0
+
+    def write(self):
+        """Writes the definition to definition_file_path. An existing file with
+        the same content is not rewritten. Returns True if the file was
+        written."""
+        written = False
+        if self.deps:
+            written = self.deps.write()
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        content = f"{self.text}\n"
+        if os.path.isfile(self.definition_file_path):
+            with open(self.definition_file_path, "r") as f:
+                if f.read() == content:
+                    return written
+        with open(self.definition_file_path, "w") as f:
+            f.write(content)
+        return True
+
+
+_recipe_codes = {}  # Compiled recipes by content hash
+
+
+def _write_code(code, pyc_file):
+    """Writes code atomically to pyc_file, continues without caching if the
+    cache is not writable"""
+    import marshal
+    import tempfile
+
+    try:
+        os.makedirs(os.path.dirname(pyc_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(pyc_file))
+    except OSError as err:
+        print(f"WARNING: Can not write the recipe cache {pyc_file}: {err}")
+        return
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            marshal.dump(code, fp)
+        os.replace(tmp_file, pyc_file)
+    except OSError as err:
+        os.remove(tmp_file)
+        print(f"WARNING: Can not write the recipe cache {pyc_file}: {err}")
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def recipe_code(recipe):
+    """Returns the compiled code of the builtin recipe with the given name or
+    of the recipe file at the given path (in this order) or None.
+
+    Code objects are cached in memory by content hash and for recipe files
+    additionally on disk (in <config.g_cache_dir>/recipes).
+    """
+    import importlib.resources
+    from ogscm import recipes as builtin_recipes
+
+    builtin = None
+    # Paths with a directory, e.g. ./my_recipe.py, are always recipe files
+    if os.path.basename(recipe) == recipe:
+        if hasattr(importlib.resources, "files"):
+            builtin = importlib.resources.files(builtin_recipes).joinpath(recipe)
+            if not builtin.is_file():
+                builtin = None
+        elif importlib.resources.is_resource(builtin_recipes, recipe):  # Python < 3.9
+            builtin = recipe
+    if builtin is not None:
+        if hasattr(importlib.resources, "files"):
+            source = builtin.read_text()
+        else:
+            source = importlib.resources.read_text(builtin_recipes, recipe)
+    elif os.path.isfile(recipe):
+        with open(recipe, "r") as reader:
+            source = reader.read()
+    else:
+        return None
+
+    import hashlib
+    import importlib.util
+
+    key = hashlib.sha256(
+        importlib.util.MAGIC_NUMBER + recipe.encode("utf-8") + source.encode("utf-8")
+    ).hexdigest()
+    if key in _recipe_codes:
+        return _recipe_codes[key]
+
+    import marshal
+
+    pyc_file = os.path.join(ogscm.config.g_cache_dir, "recipes", f"{key}.pyc")
+    code = None
+    if not builtin and os.path.isfile(pyc_file):
+        try:
+            with open(pyc_file, "rb") as fp:
+                code = marshal.load(fp)
+        except (EOFError, ValueError, TypeError):
+            code = None  # Corrupt file, recompile
+    if code is None:
+        code = compile(source, recipe, "exec")
+        if not builtin:
+            _write_code(code, pyc_file)
+    _recipe_codes[key] = code
+    return code
+
+
+def stage_runtime(stage, _from, exclude, exclude_blocks):
+    """Stage.runtime() which additionally excludes the building block
+    instances exclude_blocks, also from dependency_stages"""
+    if not exclude_blocks:
+        return stage.runtime(_from=_from, exclude=exclude)
+    instructions = []
+    # Stages do not expose their layers
+    for layer in getattr(stage, "_Stage__layers", []):
+        runtime = getattr(layer, "runtime", None)
+        if (
+            not callable(runtime)
+            or layer.__class__.__name__ in exclude
+            or any(layer is x for x in exclude_blocks)
+        ):
+            continue
+        if layer.__class__.__name__ == "dependency_stages":
+            instructions.append(runtime(_from=_from, exclude=exclude_blocks))
+        else:
+            instructions.append(runtime(_from=_from))
+    return "\n\n".join(x for x in instructions if x)
+
+
+def runtime_paths(runtime, _from):
+    """The source paths of the COPY instructions from stage _from"""
+    import json
+    import re
+
+    paths = []
+    for match in re.finditer(
+        rf"^COPY --from={_from} (.*)$", runtime.replace("\\\n", " "), re.MULTILINE
+    ):
+        arguments = match.group(1).strip()
+        if arguments.startswith("["):
+            arguments = json.loads(arguments)
+        else:
+            arguments = arguments.split()
+        paths.extend(x for x in arguments[:-1] if x not in paths)
+    return paths
+
+
+def evaluate(recipes, parser, parse_help=None):
+    """Evaluates the recipes and returns the Definition.
+
+    parser: The parser returned from argument_parser().
+    parse_help: Called after the recipes are evaluated, e.g. to print the
+    help including all recipe arguments.
+    """
+    import hpccm
+    from hpccm.building_blocks import packages, pip
+    from hpccm.primitives import baseimage, comment, raw, shell
+
+    args = parser.parse_known_args()[0]
+
+    def fail(message):
+        """Prints message and exits, in generate() raises a RuntimeError.
+        Recipes use it as well."""
+        if isinstance(parser, _argument_parser):
+            raise _EvaluationError(message)
+        print(message)
+        exit(1)
+
+    if args.profile:
+        ogscm.profiling.enable(
+            cprofile=bool(args.profile_output)
+            and not args.profile_output.endswith(".json")
+        )
+    try:
+        ogscm.config.set_cache_ttl(args.cache_ttl)
+        ogscm.config.set_offline(args.offline)
+        ogscm.lock.reset()
+        if args.from_lock:
+            ogscm.lock.load(args.from_lock)
+        # Do not depend on the settings of previous evaluations
+        hpccm.config.set_container_format("docker")
+        hpccm.config.set_singularity_version("2.6")
+        hpccm.config.set_cpu_target(args.cpu_target)
+        Stage0 = hpccm.Stage()
+        Stage0 += raw(docker="# syntax=docker/dockerfile:experimental")
+
+        if args.runtime_only:
+            Stage0.name = "build"
+        Stage0 += baseimage(image=args.base_image, _as="build")
+
+        Stage0 += comment(
+            f"Generated with ogs-container-maker {__version__}", reformat=False
+        )
+        Stage0 += packages(
+            ospackages=["wget", "tar", "curl", "ca-certificates", "make", "unzip"]
+        )
+
+        # Prepare runtime stage
+        Stage1 = hpccm.Stage()
+        if args.runtime_base_image == "":
+            Stage1.baseimage(image=args.base_image)
+        else:
+            Stage1.baseimage(image=args.runtime_base_image)
+            if args.runtime_base_image == "jupyter/base-notebook":
+                Stage1 += raw(docker="USER root")
+
+        cwd = os.getcwd()
+        img_file = ""
+        out_dir = f"{args.out}/{args.format}"
+        toolchain = None
+        deps_stage = None
+        deps_tag = ""
+        # Building blocks whose runtime only consists of libraries
+        closure_libraries = []
+
+        for recipe in recipes:
+            code = recipe_code(recipe)
+            if code is None:
+                fail(f"{recipe} does not exist!")
+
+            # Recipes see the variables above and may overwrite img_file,
+            # out_dir and toolchain. They may also move Stage0 to deps_stage
+            # (tagged deps_tag) and start a new Stage0 from it. Library-only
+            # building blocks are added to closure_libraries. Errors are
+            # reported with fail().
+            # https://stackoverflow.com/a/1463370/80480
+            namespace = dict(locals())
+            ldict = {"filename": recipe}
+            try:
+                with ogscm.profiling.timer("recipe", recipe):
+                    exec(code, namespace, ldict)
+            except _EvaluationError:
+                raise
+            except Exception as err:
+                error_class = err.__class__.__name__
+                cl, exc, tb = sys.exc_info()
+                recipe_frames = [
+                    f
+                    for f in traceback.extract_tb(tb)
+                    if f.filename == code.co_filename
+                ]
+                line_number = recipe_frames[-1].lineno if recipe_frames else "?"
+                fail(f"{error_class} in {recipe} at line {line_number}: {err}")
+            if "out_dir" in ldict:
+                out_dir = ldict["out_dir"]
+            if "toolchain" in ldict:
+                toolchain = ldict["toolchain"]
+            if "deps_stage" in ldict:
+                deps_stage = ldict["deps_stage"]
+                deps_tag = ldict["deps_tag"]
+                Stage0 = ldict["Stage0"]
+            if "img_file" not in ldict:
+                fail(f"img_file variable has to be set in {recipe}!")
+            img_file = ldict["img_file"]
+
+        if parse_help:
+            parse_help()
+
+        # Finally parse
+        args = parser.parse_args()
+
+        if args.lock:
+            ogscm.lock.save(args.lock)
+
+        ### container_info ###
+        definition_file = "Dockerfile"
+        if args.format == "singularity":
+            definition_file = "Singularity.def"
+        definition_file_path = os.path.join(out_dir, definition_file)
+        if img_file[0] == "-":
+            img_file = img_file[1:]
+        if args.tag != "":
+            tag = args.tag
+        else:
+            tag = f"{args.registry}/{img_file.lower()}:latest"
+        # TODO:
+        # context_path_size = len(self.ogsdir)
+        # "{self.out_dir[context_path_size+1:]}/{self.definition_file}"
+        ### end container_info ###
+
+        # General args
+        if args.packages:
+            Stage0 += packages(ospackages=args.packages)
+            Stage1 += packages(ospackages=args.packages)
+
+        if args.pip:
+            Stage0 += pip(packages=args.pip, pip="pip3")
+            Stage1 += pip(packages=args.pip, pip="pip3")
+
+        if args.slim and (not args.runtime_only or args.format != "docker"):
+            fail("--slim requires --runtime-only and --format docker!")
+        if args.size_budget:
+            from ogscm.app.report import parse_size
+
+            for budget in args.size_budget:
+                try:
+                    parse_size(budget.rpartition("=")[2])
+                except ValueError:
+                    fail(f"Invalid --size-budget {budget}!")
+        if args.slim_debug and not args.slim:
+            fail("--slim-debug requires --slim!")
+        if args.runtime_closure and (not args.runtime_only or args.format != "docker"):
+            fail("--runtime-closure requires --runtime-only and --format docker!")
+
+        if args.squash_profile == "custom" and not args.squash_options:
+            fail("--squash-profile custom requires --squash-options!")
+        if args.convert_direct and not (args.convert or args.convert_enroot):
+            fail("--convert-direct requires --convert or --convert-enroot!")
+        if args.convert_direct and args.upload:
+            fail("--convert-direct cannot be combined with --upload!")
+        if args.convert_direct and deps_stage is not None:
+            # The buildx builder of the OCI export cannot see the dependencies
+            # image in the local Docker daemon
+            fail("--convert-direct cannot be combined with --deps_image!")
+        if (
+            (args.cache_dir or args.cache_ref)
+            and deps_stage is not None
+            and not args.upload
+        ):
+            # The docker-container builder pulls the dependencies image from
+            # the registry
+            fail("--cache-dir and --cache-ref with --deps_image require --upload!")
+
+        # Create definition
+        hpccm.config.set_container_format(args.format)
+        hpccm.config.set_singularity_version("3.5")
+
+        if args.cache_mounts and args.format == "docker":
+            from ogscm import cache_mounts
+
+            apt_configured = False
+            if deps_stage is not None:
+                apt_configured = cache_mounts.add(deps_stage)
+            cache_mounts.add(Stage0, apt_configured)
+
+        stage0 = ogscm.profiling.render(Stage0, "Stage0")
+        stage1 = ""
+        deps = None
+        if deps_stage is not None:
+            deps = Definition(
+                args=args,
+                stage0=ogscm.profiling.render(deps_stage, "deps"),
+                img_file=f"{img_file}-deps",
+                out_dir=out_dir,
+                tag=deps_tag,
+                definition_file_path=f"{definition_file_path}.deps",
+            )
+
+        if args.runtime_only:
+            runtime_exclude = []
+            if hasattr(args, "mfront") and not args.mfront:
+                runtime_exclude.append("boost")
+            runtime_exclude_blocks = []
+            if args.runtime_closure:
+                # Their libraries are part of the closure
+                runtime_exclude_blocks = closure_libraries
+            runtime_from = Stage0.name
+            if args.slim:
+                runtime_from = "slim"
+            runtime = []
+            if deps_stage is not None:
+                runtime.append(
+                    stage_runtime(
+                        deps_stage,
+                        runtime_from,
+                        runtime_exclude,
+                        runtime_exclude_blocks,
+                    )
+                )
+            runtime.append(
+                stage_runtime(
+                    Stage0, runtime_from, runtime_exclude, runtime_exclude_blocks
+                )
+            )
+            if args.slim:
+                from ogscm.building_blocks.slim import slim
+
+                slim_stage = hpccm.Stage()
+                slim_stage += slim(
+                    base=Stage0.name,
+                    debug=args.slim_debug,
+                    paths=runtime_paths("\n".join(runtime), runtime_from),
+                )
+                stage0 = f"{stage0}\n{ogscm.profiling.render(slim_stage, 'slim')}"
+            if args.runtime_closure:
+                from ogscm.building_blocks.library_closure import library_closure
+
+                closure = library_closure(
+                    base=runtime_from,
+                    paths=runtime_paths("\n".join(runtime), runtime_from),
+                    strip=args.slim,
+                )
+                closure_stage = hpccm.Stage()
+                closure_stage += closure
+                stage0 = f"{stage0}\n{ogscm.profiling.render(closure_stage, 'closure')}"
+                runtime.append(closure.runtime(_from="closure"))
+            for instructions in runtime:
+                Stage1 += instructions
+            if (
+                hasattr(args, "compiler")
+                and args.compiler == "gcc"
+                and args.compiler_version != None
+            ):
+                Stage1 += packages(apt=["libstdc++6"])
+            if args.runtime_base_image == "jupyter/base-notebook":
+                Stage1 += raw(docker="USER ${NB_USER}")
+            stage1 = ogscm.profiling.render(Stage1, "Stage1")
+    finally:
+        if args.profile:
+            ogscm.profiling.disable()
+
+    if args.profile:
+        print(ogscm.profiling.report(), file=sys.stderr)
+        if args.profile_output:
+            ogscm.profiling.write(args.profile_output)
+            print(f"Wrote profile {args.profile_output}", file=sys.stderr)
+
+    return Definition(
+        args=args,
+        stage0=stage0,
+        stage1=stage1,
+        img_file=img_file,
+        out_dir=out_dir,
+        tag=tag,
+        definition_file_path=definition_file_path,
+        context=os.getcwd(),
+        deps=deps,
+    )
+
+
+def generate(recipes, options=None):
+    """Generates a definition from recipes (e.g. ["compiler.py", "ogs.py"])
+    and options (a dict, e.g. {"compiler": "clang", "ccache": True}) in-process.
+
+    Neither sys.argv, the current working directory nor the exit status are
+    touched. Errors raise a RuntimeError. Nothing is written, see
+    Definition.write().
+    """
+    parser = argument_parser(recipes, options or {})
+    cwd = os.getcwd()
+    try:
+        return evaluate(recipes, parser)
+    except SystemExit as err:
+        raise RuntimeError(f"Recipe evaluation exited with status {err.code}")
+    finally:
+        # E.g. ogs.py changes into a local OGS source directory
+        os.chdir(cwd)
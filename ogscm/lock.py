@@ -0,0 +1,64 @@
+"""Resolution lockfile
+
+Recipes record everything they resolve at evaluation time (commits,
+versions.json contents, dependency versions) with record(). After load()ing a
+lockfile, locked() returns the recorded values of a recipe so that it can
+skip all network and git lookups.
+"""
+
+from __future__ import absolute_import
+
+import json
+import sys
+
+from ogscm.version import __version__
+
+g_locked = None  # Content of the loaded lockfile
+g_resolved = {}  # Values recorded by recipes in this run
+
+
+def load(path):
+    this = sys.modules[__name__]
+    with open(path, "r") as fp:
+        this.g_locked = json.load(fp)["recipes"]
+
+
+def save(path):
+    with open(path, "w") as fp:
+        json.dump(
+            {"ogscm_version": __version__, "recipes": g_resolved},
+            fp,
+            indent=2,
+            sort_keys=True,
+        )
+        fp.write("\n")
+
+
+def reset():
+    this = sys.modules[__name__]
+    this.g_locked = None
+    this.g_resolved = {}
+
+
+def locked(recipe):
+    """Returns the recorded values of recipe or None if no lockfile was
+    loaded."""
+    if g_locked is None:
+        return None
+    if recipe not in g_locked:
+        raise RuntimeError(f"{recipe} is not contained in the lockfile!")
+    return g_locked[recipe]
+
+
+def check_option(option, value, default, locked_value):
+    """Warns if the option was given (value is not its default) but differs
+    from the locked value which is used instead"""
+    if value != default and value != locked_value:
+        print(
+            f"WARNING: {option} {value} differs from the lockfile, using the "
+            f"locked {locked_value}."
+        )
+
+
+def record(recipe, values):
+    g_resolved[recipe] = values
@@ -0,0 +1,151 @@
+"""Profiling of the definition generation (--profile)
+
+Records the wall time of each recipe evaluation, network lookup, subprocess
+call (e.g. git in ogs.py) and building block render with timer(). report()
+returns the records sorted by time. write() saves them as speedscope
+profile (*.json, https://www.speedscope.app) or, when a cProfile profiler was
+started with enable(), the cProfile statistics (any other file name).
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import json
+import subprocess
+import sys
+import threading
+import time
+
+g_enabled = False
+g_start = 0.0
+g_records = []  # (category, name, start, end, thread id)
+g_cprofile = None
+g_subprocess_run = subprocess.run
+
+
+def _run(*args, **kwargs):
+    """subprocess.run recording its wall time"""
+    command = args[0] if args else kwargs.get("args", "")
+    if isinstance(command, (list, tuple)):
+        command = " ".join(str(x) for x in command)
+    with timer("subprocess", command):
+        return g_subprocess_run(*args, **kwargs)
+
+
+def enable(cprofile=False):
+    """Starts recording, with cprofile additionally with cProfile"""
+    this = sys.modules[__name__]
+    this.g_enabled = True
+    this.g_start = time.perf_counter()
+    this.g_records = []
+    subprocess.run = _run
+    if cprofile:
+        import cProfile
+
+        this.g_cprofile = cProfile.Profile()
+        this.g_cprofile.enable()
+
+
+def disable():
+    this = sys.modules[__name__]
+    this.g_enabled = False
+    subprocess.run = g_subprocess_run
+    if this.g_cprofile is not None:
+        this.g_cprofile.disable()
+
+
+@contextlib.contextmanager
+def timer(category, name):
+    """Records the wall time of the enclosed code"""
+    if not g_enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g_records.append(
+            (category, name, start, time.perf_counter(), threading.get_ident())
+        )
+
+
+def render(stage, name):
+    """Returns str(stage), recording the render time of each building block
+    of the stage"""
+    if not g_enabled:
+        return str(stage)
+    # Stages do not expose their layers
+    for layer in getattr(stage, "_Stage__layers", []):
+        with timer("render", f"{name}: {layer.__class__.__name__}"):
+            str(layer)
+    with timer("render", name):
+        return str(stage)
+
+
+def report():
+    """The records sorted by wall time and the totals per category"""
+    total = time.perf_counter() - g_start
+    totals = {}
+    for category, _, start, end, _ in g_records:
+        totals[category] = totals.get(category, 0.0) + end - start
+    lines = [f"Profile: {total:.3f} s in total"]
+    for category, seconds in sorted(totals.items(), key=lambda x: -x[1]):
+        lines.append(f"  {seconds:8.3f} s  {category}")
+    lines.append("")
+    for category, name, start, end, _ in sorted(g_records, key=lambda x: x[2] - x[3]):
+        name = name if len(name) <= 100 else f"{name[:97]}..."
+        lines.append(f"  {end - start:8.3f} s  {category:<10}  {name}")
+    return "\n".join(lines)
+
+
+def write(path):
+    """Writes the cProfile statistics or, for *.json, a speedscope profile
+    with one profile per thread"""
+    if not path.endswith(".json"):
+        if g_cprofile is None:
+            raise RuntimeError("cProfile was not enabled!")
+        g_cprofile.dump_stats(path)
+        return
+
+    frames = []
+    frame_index = {}
+    events = {}
+    for category, name, start, end, thread in g_records:
+        key = f"{category}: {name}"
+        if key not in frame_index:
+            frame_index[key] = len(frames)
+            frames.append({"name": key})
+        thread_events = events.setdefault(thread, [])
+        thread_events.append((start - g_start, 1, "O", frame_index[key], end))
+        thread_events.append((end - g_start, 0, "C", frame_index[key], start))
+    profiles = []
+    for number, thread in enumerate(sorted(events)):
+        # Closing before opening at the same time, inner before outer
+        thread_events = sorted(events[thread], key=lambda x: (x[0], x[1], -x[4]))
+        profiles.append(
+            {
+                "type": "evented",
+                "name": (
+                    "main"
+                    if thread == threading.main_thread().ident
+                    else f"thread {number}"
+                ),
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": max(x[0] for x in thread_events),
+                "events": [
+                    {"type": x[2], "frame": x[3], "at": x[0]} for x in thread_events
+                ],
+            }
+        )
+    with open(path, "w") as fp:
+        json.dump(
+            {
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "shared": {"frames": frames},
+                "profiles": profiles,
+                "name": "ogscm",
+                "exporter": "ogscm",
+            },
+            fp,
+        )
@@ -73,8 +73,7 @@ if local_args.compiler == "gcc" and local_args.compiler_version is not None:
     Stage0 += packages(apt=["libstdc++6"])
 
 if local_args.iwyy and local_args.compiler != "clang":
-    print("--iwyy can only be used with --compiler clang")
-    exit(1)
+    fail("--iwyy can only be used with --compiler clang")
 if local_args.iwyy:
     Stage0 += packages(
         ospackages=[
@@ -16,6 +16,8 @@ from hpccm.building_blocks import (
 )
 from hpccm.primitives import comment, copy, label, shell, environment, runscript
 
+from ogscm import lock
+
 print(f"Evaluating {filename}")
 
 # Add cli arguments to args_parser
@@ -60,6 +62,14 @@ parse_g.add_argument(
 # Parse local args
 local_args = parser.parse_known_args()[0]
 
+locked = lock.locked(filename)
+if locked:
+    lock.check_option(
+        "--ompi", local_args.ompi, parser.get_default("ompi"), locked["ompi"]
+    )
+    local_args.ompi = locked["ompi"]
+lock.record(filename, {"ompi": local_args.ompi})
+
 # set image file name
 img_file += f"-openmpi-{local_args.ompi}"
 
@@ -4,8 +4,9 @@ import json
 import math
 import multiprocessing
 import re
-import requests
 
+from ogscm import lock, resolver
+from ogscm.building_blocks.build_jobs import build_jobs
 from ogscm.building_blocks.ogs_base import ogs_base
 from hpccm.building_blocks import (
     boost,
@@ -21,6 +22,7 @@ from hpccm.building_blocks import (
 import hpccm
 from ogscm.building_blocks.paraview import paraview
 from ogscm.building_blocks.ccache import ccache
+from ogscm.building_blocks.dependency_stages import dependency_stages
 from hpccm.primitives import comment, copy, environment, raw, shell
 from hpccm import linux_distro
 import os
@@ -73,7 +75,9 @@ parse_g.add_argument(
     "--ccache",
     dest="ccache",
     action="store_true",
-    help="Enables ccache build caching. (Docker-only)",
+    help="Enables ccache build caching for OGS, VTK, ParaView, PETSc and HDF5. "
+    "The ccache statistics of each build are written to the build report. "
+    "(Docker-only)",
 )
 parse_g.add_argument(
     "--cpmcache",
@@ -81,12 +85,29 @@ parse_g.add_argument(
     action="store_true",
     help="Enables CPM source caching. (Docker-only)",
 )
+parse_g.add_argument(
+    "--dependency_stages",
+    dest="dependency_stages",
+    action="store_true",
+    help="Builds each third-party dependency in its own stage so that they "
+    "can be built concurrently. (Docker-only)",
+)
+parse_g.add_argument(
+    "--deps_image",
+    dest="deps_image",
+    action="store_true",
+    help="Builds all dependencies into a separate image which is tagged with "
+    "a hash of its definition and reused if it exists locally or in --registry. "
+    "(Docker-only)",
+)
 parse_g.add_argument(
     "--parallel",
     "-j",
     type=str,
     default=math.ceil(multiprocessing.cpu_count() / 2),
-    help="The number of cores to use for compilation.",
+    help="The number of cores to use for compilation. 'auto' derives the "
+    "number of compile and link jobs (Ninja job pools) and a load limit from the "
+    "cores and memory available at build time.",
 )
 parse_g.add_argument(
     "--gui",
@@ -146,96 +167,114 @@ parse_g.add_argument("--version_file", type=str, help="OGS versions.json file")
 # Parse local args
 local_args = parser.parse_known_args()[0]
 
-branch_is_release = False
-git_version = ""
-name_start = ""
-repo = None
-versions = None
-versions_master = json.loads(
-    requests.get(
-        f"https://gitlab.opengeosys.org/ogs/ogs/-/raw/master/web/data/versions.json?inline=false"
-    ).text
-)
-
-if local_args.ogs not in ["off", "clean"]:  # != "off" and local_args.ogs != "clean":
-    if os.path.isdir(local_args.ogs):
-        repo = "local"
-        commit_hash = subprocess.run(
-            ["cd {} && git rev-parse HEAD".format(local_args.ogs)],
-            capture_output=True,
-            text=True,
-            shell=True,
-        ).stdout.rstrip()
-        with open(f"{local_args.ogs}/web/data/versions.json") as fp:
-            versions = json.load(fp)
-        if "GITLAB_CI" in os.environ:
-            if "CI_COMMIT_TAG" in os.environ:
-                branch = "master"
-            elif "CI_COMMIT_BRANCH" in os.environ:
-                branch = os.environ["CI_COMMIT_BRANCH"]
-            elif "CI_MERGE_REQUEST_SOURCE_BRANCH_NAME" in os.environ:
-                branch = os.environ["CI_MERGE_REQUEST_SOURCE_BRANCH_NAME"]
-            if "OGS_VERSION" in os.environ:
-                git_version = os.environ["OGS_VERSION"]
-        else:
-            branch = subprocess.run(
-                [
-                    "cd {} && git branch | grep \* | cut -d ' ' -f2".format(
-                        local_args.ogs
-                    )
-                ],
-                capture_output=True,
-                text=True,
-                shell=True,
-            ).stdout
-            git_version = subprocess.run(
-                ["cd {} && git describe --tags".format(local_args.ogs)],
+locked = lock.locked(filename)
+if locked:
+    # Lockfiles of older versions did not record --ogs
+    if "ogs" in locked:
+        lock.check_option(
+            "--ogs", local_args.ogs, parser.get_default("ogs"), locked["ogs"]
+        )
+        local_args.ogs = locked["ogs"]
+    repo = locked["repo"]
+    branch = locked["branch"]
+    commit_hash = locked["commit"]
+    git_version = locked["git_version"]
+    name_start = locked["name_start"]
+    versions = locked["versions"]
+    dependency_versions = locked["dependency_versions"]
+else:
+    branch = None
+    branch_is_release = False
+    commit_hash = None
+    git_version = ""
+    name_start = ""
+    repo = None
+    versions = None
+    versions_master = None
+
+    if local_args.ogs not in ["off", "clean"]:
+        if os.path.isdir(local_args.ogs):
+            repo = "local"
+            commit_hash = subprocess.run(
+                ["cd {} && git rev-parse HEAD".format(local_args.ogs)],
                 capture_output=True,
                 text=True,
                 shell=True,
-            ).stdout.strip()
-    else:
-        # Get git commit hash and construct image tag name
-        repo, branch, *commit = local_args.ogs.split("@")
-        if commit:
-            commit_hash = commit[0]
-            if branch == "":
-                branch = "master"
-            versions = json.loads(
-                requests.get(
-                    f"https://gitlab.opengeosys.org/{repo}/-/raw/{commit_hash}/web/data/versions.json"
-                ).text
-            )
+            ).stdout.rstrip()
+            with open(f"{local_args.ogs}/web/data/versions.json") as fp:
+                versions = json.load(fp)
+            if "GITLAB_CI" in os.environ:
+                if "CI_COMMIT_TAG" in os.environ:
+                    branch = "master"
+                elif "CI_COMMIT_BRANCH" in os.environ:
+                    branch = os.environ["CI_COMMIT_BRANCH"]
+                elif "CI_MERGE_REQUEST_SOURCE_BRANCH_NAME" in os.environ:
+                    branch = os.environ["CI_MERGE_REQUEST_SOURCE_BRANCH_NAME"]
+                if "OGS_VERSION" in os.environ:
+                    git_version = os.environ["OGS_VERSION"]
+            else:
+                branch = subprocess.run(
+                    [
+                        "cd {} && git branch | grep \* | cut -d ' ' -f2".format(
+                            local_args.ogs
+                        )
+                    ],
+                    capture_output=True,
+                    text=True,
+                    shell=True,
+                ).stdout
+                git_version = subprocess.run(
+                    ["cd {} && git describe --tags".format(local_args.ogs)],
+                    capture_output=True,
+                    text=True,
+                    shell=True,
+                ).stdout.strip()
         else:
-            if re.search(r"[\d.]+", branch):
+            # Get git commit hash and construct image tag name
+            repo, branch, commit = resolver.split_ref(local_args.ogs)
+            if not commit and re.search(r"[\d.]+", branch):
                 branch_is_release = True
-            repo_split = repo.split("/")
-            response = requests.get(
-                f"https://gitlab.opengeosys.org/api/v4/projects/{repo.replace('/', '%2F')}/repository/commits?ref_name={branch}"
-            )
-            response_data = json.loads(response.text)
-            commit_hash = response_data[0]["id"]
-            # ogs_tag = args.ogs.replace('/', '.').replace('@', '.')
-            versions = json.loads(
-                requests.get(
-                    f"https://gitlab.opengeosys.org/{repo}/-/raw/{branch}/web/data/versions.json"
-                ).text
+            commit_hash, versions, versions_master = resolver.resolve(
+                repo, branch, commit
             )
 
-        if branch_is_release:
-            name_start = f"ogs-{branch}"
-        else:
-            name_start = f"ogs-{commit_hash[:8]}"
-
-if local_args.version_file:
-    with open(local_args.version_file) as fp:
-        versions = json.load(fp)
-if versions == None:
-    versions = json.loads(
-        requests.get(
-            f"https://gitlab.opengeosys.org/ogs/ogs/-/raw/master/web/data/versions.json"
-        ).text
-    )
+            if branch_is_release:
+                name_start = f"ogs-{branch}"
+            else:
+                name_start = f"ogs-{commit_hash[:8]}"
+
+    if versions_master == None:
+        _, _, versions_master = resolver.resolve()
+    if local_args.version_file:
+        with open(local_args.version_file) as fp:
+            versions = json.load(fp)
+    if versions == None:
+        versions = versions_master
+
+    # Dependency versions, fall back to master versions.json
+    dependency_versions = {
+        "cmake": versions["tested_version"].get(
+            "cmake", versions_master["tested_version"]["cmake"]
+        )
+    }
+    for dependency in ["boost", "eigen", "hdf5", "petsc", "qt", "tfel-rliv", "vtk"]:
+        dependency_versions[dependency] = versions["minimum_version"].get(
+            dependency, versions_master["minimum_version"].get(dependency)
+        )
+
+lock.record(
+    filename,
+    {
+        "ogs": locked.get("ogs") if locked else local_args.ogs,
+        "repo": repo,
+        "branch": branch,
+        "commit": commit_hash,
+        "git_version": git_version,
+        "name_start": name_start,
+        "versions": versions,
+        "dependency_versions": dependency_versions,
+    },
+)
 
 if local_args.cmake_preset_file:
     # Make path absolute
@@ -263,12 +302,39 @@ if local_args.ogs != "off" and not args.runtime_only:
 # Optionally set out_dir
 out_dir += folder
 
+if local_args.dependency_stages and args.format != "docker":
+    fail("--dependency_stages can only be used with --format docker!")
+if local_args.deps_image and args.format != "docker":
+    fail("--deps_image can only be used with --format docker!")
+
 # Implement recipe
 Stage0 += comment(f"--- Begin {filename} ---")
 
+# Dependencies which are built in their own stage with --dependency_stages
+dependencies = []
+
 cmake_args = local_args.cmake_args.strip().split(" ")
 
 Stage0 += ogs_base()
+
+# Parallelism of the CMake builds
+parallel = local_args.parallel
+dependency_parallel = "$(nproc)"
+job_pool_args = []
+if local_args.parallel == "auto":
+    jobs = build_jobs()
+    Stage0 += jobs
+    parallel = jobs.parallel()
+    dependency_parallel = parallel
+    job_pool_args = jobs.cmake_args()
+
+# Compiler caching of OGS and the larger dependencies
+ccache_block = None
+ccache_cmake_args = []
+if local_args.ccache:
+    ccache_block = ccache(cache_size="15G")
+    Stage0 += ccache_block
+    ccache_cmake_args = ccache_block.launcher_args()
 if local_args.gui:
     Stage0 += packages(
         apt=[
@@ -295,9 +361,7 @@ if local_args.gui:
         yum=["mesa-libOSMesa", "mesa-libGL", "mesa-libGLU", "libXt"],
     )
 if local_args.ogs != "clean":
-    cmake_version = versions_master["tested_version"]["cmake"]
-    if "cmake" in versions["tested_version"]:
-        cmake_version = versions["tested_version"]["cmake"]
+    cmake_version = dependency_versions["cmake"]
     Stage0 += cmake(eula=True, version=cmake_version)
     if local_args.pm == "system":
         boost_bootsrap_opts = []
@@ -306,13 +370,25 @@ if local_args.ogs != "clean":
             boost_bootsrap_opts = ["--with-python=python3"]
         if toolchain.CC == "clang":
             boost_bootsrap_opts.append("--with-toolset=clang")
-        Stage0 += boost(
+        boost_block = boost(
             b2_opts=["headers"],
-            baseurl=f"https://boostorg.jfrog.io/artifactory/main/release/{versions['minimum_version']['boost']}/source",
+            baseurl=f"https://boostorg.jfrog.io/artifactory/main/release/{dependency_versions['boost']}/source",
             bootstrap_opts=boost_bootsrap_opts,
             ldconfig=True,
-            version=versions["minimum_version"]["boost"],
+            version=dependency_versions["boost"],
         )
+        closure_libraries.append(boost_block)
+        if local_args.dependency_stages:
+            dependencies.append(
+                {
+                    "name": "boost",
+                    "block": boost_block,
+                    "prefix": "/usr/local/boost",
+                    "runtime": local_args.mfront,
+                }
+            )
+        else:
+            Stage0 += boost_block
         Stage0 += environment(variables={"BOOST_ROOT": "/usr/local/boost"})
         Stage0 += packages(
             apt=["libxml2-dev", "xsltproc"], yum=["libxml2-devel", "libxslt"]
@@ -384,7 +460,7 @@ if local_args.ogs != "clean":
             )
             # TODO: will not work with clang
             qt_install_dir = "/opt/qt"
-            qt_version = versions["minimum_version"]["qt"]
+            qt_version = dependency_versions["qt"]
             qt_dir = f"{qt_install_dir}/{qt_version}/gcc_64"
             Stage0 += pip(pip="pip3", packages=["aqtinstall==1.2.5"])
             Stage0 += shell(
@@ -418,29 +494,57 @@ if local_args.ogs != "clean":
             )
         if local_args.insitu:
             if local_args.gui:
-                print("--gui can not be used with --insitu!")
-                exit(1)
-            Stage0 += paraview(
-                cmake_args=["-DPARAVIEW_USE_PYTHON=ON"],
+                fail("--gui can not be used with --insitu!")
+            paraview_block = paraview(
+                cmake_args=["-DPARAVIEW_USE_PYTHON=ON"]
+                + job_pool_args
+                + ccache_cmake_args,
                 edition="CATALYST",
                 ldconfig=True,
+                parallel=dependency_parallel,
                 toolchain=toolchain,
                 version="v5.8.1",
             )
+            if ccache_block:
+                ccache_block.enable(paraview_block, "paraview")
+            if local_args.dependency_stages:
+                paraview_libdir = "lib"
+                if hpccm.config.g_linux_distro == linux_distro.CENTOS:
+                    paraview_libdir = "lib64"
+                dependencies.append(
+                    {
+                        "name": "paraview",
+                        "block": paraview_block,
+                        "prefix": "/usr/local/paraview",
+                        "libdir": paraview_libdir,
+                    }
+                )
+            else:
+                Stage0 += paraview_block
         else:
-            vtk_version = versions["minimum_version"]["vtk"]
-            Stage0 += generic_cmake(
-                cmake_opts=vtk_cmake_args,
+            vtk_version = dependency_versions["vtk"]
+            vtk_block = generic_cmake(
+                cmake_opts=vtk_cmake_args + job_pool_args + ccache_cmake_args,
                 devel_environment={"VTK_ROOT": "/usr/local/vtk"},
                 directory=f"VTK-{vtk_version}",
                 ldconfig=True,
+                parallel=dependency_parallel,
                 prefix="/usr/local/vtk",
                 toolchain=toolchain,
                 url=f"https://www.vtk.org/files/release/{vtk_version[:-2]}/VTK-{vtk_version}.tar.gz",
             )
+            closure_libraries.append(vtk_block)
+            if ccache_block:
+                ccache_block.enable(vtk_block, "vtk")
+            if local_args.dependency_stages:
+                dependencies.append(
+                    {"name": "vtk", "block": vtk_block, "prefix": "/usr/local/vtk"}
+                )
+            else:
+                Stage0 += vtk_block
         if toolchain.CC == "mpicc":
             Stage0 += packages(yum=["diffutils"])
-            petsc_version = versions["minimum_version"]["petsc"]
+            petsc_version = dependency_versions["petsc"]
             petsc_args = local_args.petsc_configure_args.strip().split(" ")
             petsc_configure_opts = [
                 f"CC={toolchain.CC}",
@@ -454,7 +558,7 @@ if local_args.ogs != "clean":
                 "--with-debugging=no",
             ]
             petsc_configure_opts.extend(petsc_args)
-            Stage0 += generic_autotools(
+            petsc_block = generic_autotools(
                 configure_opts=petsc_configure_opts,
                 devel_environment={"PETSC_DIR": "/usr/local/petsc"},
                 directory=f"petsc-{petsc_version}",
@@ -464,49 +568,90 @@ if local_args.ogs != "clean":
                 toolchain=toolchain,
                 url=f"http://ftp.mcs.anl.gov/pub/petsc/release-snapshots/petsc-lite-{petsc_version}.tar.gz",
             )
+            closure_libraries.append(petsc_block)
+            if ccache_block:
+                # PETSc's configure does not support compiler launchers
+                ccache_block.enable(petsc_block, "petsc", masquerade=True)
+            if local_args.dependency_stages:
+                dependencies.append(
+                    {
+                        "name": "petsc",
+                        "block": petsc_block,
+                        "prefix": "/usr/local/petsc",
+                    }
+                )
+            else:
+                Stage0 += petsc_block
 
-        eigen_version = versions["minimum_version"]["eigen"]
-        Stage0 += generic_cmake(
+        eigen_version = dependency_versions["eigen"]
+        eigen_block = generic_cmake(
+            cmake_opts=job_pool_args,
             devel_environment={
                 "Eigen3_ROOT": "/usr/local/eigen",
                 "Eigen3_DIR": "/usr/local/eigen",
             },
             directory=f"eigen-{eigen_version}",
+            parallel=dependency_parallel,
             prefix="/usr/local/eigen",
             toolchain=toolchain,
             url=f"https://gitlab.com/libeigen/eigen/-/archive/{eigen_version}/eigen-{eigen_version}.tar.gz",
         )
+        closure_libraries.append(eigen_block)
+        if local_args.dependency_stages:
+            dependencies.append(
+                {"name": "eigen", "block": eigen_block, "prefix": "/usr/local/eigen"}
+            )
+        else:
+            Stage0 += eigen_block
         hdf5_cofigure_opts = ["--enable-cxx"]
         if toolchain.CC == "mpicc":
             hdf5_cofigure_opts = ["--enable-parallel", "--enable-shared"]
-        hdf5_version = versions_master["minimum_version"]["hdf5"]
-        if "hdf5" in versions["minimum_version"]:
-            hdf5_version = versions["minimum_version"]["hdf5"]
-        Stage0 += hdf5(
+        hdf5_version = dependency_versions["hdf5"]
+        hdf5_block = hdf5(
             configure_opts=hdf5_cofigure_opts,
             ldconfig=True,
             toolchain=toolchain,
             version=hdf5_version,
         )
+        closure_libraries.append(hdf5_block)
+        if ccache_block:
+            ccache_block.enable(hdf5_block, "hdf5", masquerade=True)
+        if local_args.dependency_stages:
+            dependencies.append(
+                {"name": "hdf5", "block": hdf5_block, "prefix": "/usr/local/hdf5"}
+            )
+        else:
+            Stage0 += hdf5_block
 if local_args.cvode:
     # TODO version
-    Stage0 += generic_cmake(
+    cvode_block = generic_cmake(
         cmake_opts=[
             "-D EXAMPLES_INSTALL=OFF",
             "-D BUILD_SHARED_LIBS=OFF",
             "-D CMAKE_POSITION_INDEPENDENT_CODE=ON",
-        ],
+        ]
+        + job_pool_args,
         devel_environment={"CVODE_ROOT": "/usr/local/cvode"},
         directory="cvode-2.8.2",
+        parallel=dependency_parallel,
         prefix="/usr/local/cvode",
         toolchain=toolchain,
         url="https://github.com/ufz/cvode/archive/2.8.2.tar.gz",
     )
+    closure_libraries.append(cvode_block)
+    if local_args.dependency_stages:
+        dependencies.append(
+            {"name": "cvode", "block": cvode_block, "prefix": "/usr/local/cvode"}
+        )
+    else:
+        Stage0 += cvode_block
 
 if local_args.cppcheck:
     Stage0 += generic_cmake(
+        cmake_opts=job_pool_args,
         devel_environment={"PATH": "/usr/local/cppcheck/bin:$PATH"},
         directory="cppcheck-809a769c690d8ab6fef293e41a29c8490512866e",
+        parallel=dependency_parallel,
         prefix="/usr/local/cppcheck",
         runtime_environment={"PATH": "/usr/local/cppcheck/bin:$PATH"},
         toolchain=toolchain,
@@ -524,19 +669,26 @@ if local_args.dev:
     )
 
 if local_args.mfront and local_args.pm == "system":
-    tfel_version = versions_master["minimum_version"]["tfel-rliv"]
-    if "tfel-rliv" in versions["minimum_version"]:
-        tfel_version = versions["minimum_version"]["tfel-rliv"]
-    Stage0 += generic_cmake(
-        cmake_opts=["-Denable-python-bindings=ON"],
+    tfel_version = dependency_versions["tfel-rliv"]
+    tfel_block = generic_cmake(
+        cmake_opts=["-Denable-python-bindings=ON"] + job_pool_args,
         directory=f"tfel-rliv-{tfel_version}",
         ldconfig=True,
+        parallel=dependency_parallel,
         url=f"https://github.com/thelfer/tfel/archive/refs/heads/rliv-{tfel_version}.zip",
         prefix="/usr/local/tfel",
         runtime_environment={"PATH": "/usr/local/tfel/bin:$PATH"},
         devel_environment={"PATH": "/usr/local/tfel/bin:$PATH"},
         toolchain=toolchain,
     )
+    if local_args.dependency_stages:
+        tfel_stage = {"name": "tfel", "block": tfel_block, "prefix": "/usr/local/tfel"}
+        # The python bindings are built against boost
+        if any(dependency["name"] == "boost" for dependency in dependencies):
+            tfel_stage["base"] = "boost"
+        dependencies.append(tfel_stage)
+    else:
+        Stage0 += tfel_block
     tfel_env = environment(
         variables={
             "TFELHOME": "/usr/local/tfel",
@@ -554,8 +706,27 @@ if local_args.mkl:
     Stage0 += packages(apt=["lib32stdc++6"], yum=["libstdc++.i686"])
     cmake_args.append("-DOGS_USE_MKL=ON")
 
-if local_args.ccache:
-    Stage0 += ccache(cache_size="15G")
+if dependencies:
+    Stage0 += dependency_stages(stages=dependencies)
+    # Runtime files are copied from the last stage
+    Stage0.name = "ogs"
+
+if local_args.deps_image:
+    # Everything up to here goes into the dependencies image. Its tag is the
+    # hash of its definition (which contains the toolchain and the dependency
+    # versions), the cpu target and the package manager.
+    deps_stage = Stage0
+    deps_hash = hashlib.sha256(str(deps_stage).encode("utf-8"))
+    deps_hash.update(
+        json.dumps(
+            [args.cpu_target, local_args.pm, dependency_versions], sort_keys=True
+        ).encode("utf-8")
+    )
+    deps_tag = f"{args.registry}/ogs-deps:{deps_hash.hexdigest()[:16]}"
+    Stage0 = hpccm.Stage(name="build")
+    Stage0 += raw(docker="# syntax=docker/dockerfile:experimental")
+    Stage0 += raw(docker=f"FROM {deps_tag} AS build")
+
 if local_args.ogs != "off" and local_args.ogs != "clean":
     mount_args = ""
     if local_args.ccache:
@@ -576,20 +747,24 @@ if local_args.ogs != "off" and local_args.ogs != "clean":
         print(f"chdir to {local_args.ogs}")
         os.chdir(local_args.ogs)
 
-    Stage0 += ogs(
+    ogs_block = ogs(
         repo=repo,
         branch=branch,
         commit=commit_hash,
         git_version=git_version,
         toolchain=toolchain,
         cmake_args=cmake_args,
+        cmake_opts=job_pool_args,
         cmake_preset=local_args.cmake_preset,
         cmake_preset_file=local_args.cmake_preset_file,
-        parallel=local_args.parallel,
+        parallel=parallel,
         remove_build=True,
         remove_source=True,
         mount_args=mount_args,
     )
+    if ccache_block:
+        ccache_block.enable(ogs_block, "ogs")
+    Stage0 += ogs_block
 
 # Required for vtk from Python (for notebooks, VTUInterface)
 # https://github.com/Kaggle/docker-python/pull/358
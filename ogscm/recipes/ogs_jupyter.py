@@ -12,11 +12,10 @@ parse_g = parser.add_argument_group(filename)
 local_args = parser.parse_known_args()[0]
 
 if not local_args.runtime_base_image.startswith("jupyter/"):
-    print(
+    fail(
         "The ogs_jupyter.py recipe requires a Jupyter base image for the "
         "runtime stage! E.g. --runtime_base_image jupyter/base-notebook"
     )
-    exit(1)
 
 img_file += f"-jupyter"
 out_dir += f"/jupyter"
@@ -0,0 +1,125 @@
+"""Resolves OGS commits and versions.json files from gitlab.opengeosys.org
+
+All lookups go through one pooled session with retries and are issued
+concurrently. Responses are cached with ogscm.cache, resolved refs are
+additionally kept in memory for the cache TTL (e.g. for many definitions
+generated in one process or in forked workers).
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ogscm import cache, config
+
+gitlab_url = "https://gitlab.opengeosys.org"
+timeout = (10, 60)  # (connect, read) in seconds
+retries = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+)
+
+g_session = None
+g_resolved = {}  # (repo, branch, commit) -> (time, result)
+
+
+def session():
+    """Returns the shared requests session"""
+    this = sys.modules[__name__]
+    if this.g_session is None:
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+        this.g_session = requests.Session()
+        this.g_session.mount("https://", adapter)
+        this.g_session.mount("http://", adapter)
+    return this.g_session
+
+
+def versions_url(repo, ref):
+    return f"{gitlab_url}/{repo}/-/raw/{ref}/web/data/versions.json"
+
+
+def commits_url(repo, branch):
+    return (
+        f"{gitlab_url}/api/v4/projects/{repo.replace('/', '%2F')}"
+        f"/repository/commits?ref_name={branch}"
+    )
+
+
+def fetch(urls):
+    """Returns the response bodies of urls (in the same order), fetched
+    concurrently. Duplicate urls are fetched once."""
+    unique_urls = list(dict.fromkeys(urls))
+    if len(unique_urls) == 1:
+        body = cache.get(unique_urls[0], session=session(), timeout=timeout)
+        return [body for _ in urls]
+    with ThreadPoolExecutor(max_workers=len(unique_urls)) as executor:
+        futures = {
+            url: executor.submit(cache.get, url, session=session(), timeout=timeout)
+            for url in unique_urls
+        }
+        return [futures[url].result() for url in urls]
+
+
+def split_ref(ref):
+    """Splits an OGS ref 'user/repo@branch' or 'user/repo@@commit' into
+    (repo, branch, commit). commit is None for branches, branch is master for
+    commits without branch."""
+    repo, branch, *commit = ref.split("@")
+    if commit:
+        return repo, branch or "master", commit[0]
+    return repo, branch, None
+
+
+def prefetch(refs):
+    """Resolves OGS refs (as given to --ogs) concurrently. Values which are
+    not refs, e.g. off or local directories, are skipped. Errors are ignored
+    here, they show up when the ref is resolved again."""
+    keys = set([(None, None, None)])
+    for ref in refs:
+        if ref not in ["off", "clean"] and not os.path.isdir(ref):
+            keys.add(split_ref(ref))
+    with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+        for future in [executor.submit(resolve, *key) for key in keys]:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+
+def resolve(repo=None, branch=None, commit=None):
+    """Resolves an OGS repo given as user/repo@branch or user/repo@@commit.
+
+    Returns a tuple (commit_hash, versions, versions_master). Without repo only
+    versions_master is looked up and the other values are None. With a commit
+    the branch is not looked up.
+    """
+    key = (repo, branch, commit)
+    if key in g_resolved:
+        resolved_time, result = g_resolved[key]
+        if config.g_offline or time.time() - resolved_time < config.g_cache_ttl:
+            return result
+
+    urls = [versions_url("ogs/ogs", "master")]
+    if repo and commit:
+        urls.append(versions_url(repo, commit))
+    elif repo:
+        urls.extend([versions_url(repo, branch), commits_url(repo, branch)])
+    responses = fetch(urls)
+
+    versions_master = json.loads(responses[0])
+    versions = None
+    if repo:
+        versions = json.loads(responses[1])
+    if repo and not commit:
+        commit = json.loads(responses[2])[0]["id"]
+    g_resolved[key] = (time.time(), (commit, versions, versions_master))
+    return commit, versions, versions_master